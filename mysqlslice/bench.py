@@ -0,0 +1,281 @@
+#! /usr/bin/env python3
+import json
+import time
+import random
+import subprocess
+
+from mysqlslice.cli import pull_arg_parser, Prindenter, Indent, INFO, QUIET, show_do_query
+
+from mysqlslice.mysql import LocalConnection, LocalArgs, RemoteConnection, RemoteArgs
+
+from mysqlslice.sync import general_sync, keyset_sync
+
+from mysqlslice.verify import checksums_match
+
+from mysqlslice.fingerprint import BucketEngine
+
+from mysqlslice.metrics import metrics
+
+# Benchmarks
+# ==========
+
+# Builds the same synthetic table on both sides, changes the remote copy, and times each strategy
+# as it brings the local copy back in line.  Point it at a throwaway pair of databases (i.e. on one
+# local server, as with test.sh): the benchmark table is dropped and rebuilt before every run.
+# Each run is appended to a results file as one line of json, and compared against the last run
+# of the same case, so you can see whether a change made things faster.
+
+#     bench_slice --rows 100000 --updates 500 --distribution scattered --strategies general_sync recursive
+
+table_name = 'bench'
+
+# the ways to sync the benchmark table, each called like:
+#     strategy(table_name, interval_size, cli_args, local_args, remote_connection, printer)
+strategies = {
+        'general_sync' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, printer=printer),
+
+        'recursive' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, fanout=10, printer=printer),
+
+        'bucket' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, engine=BucketEngine(), printer=printer),
+
+        'concurrent' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, remote_workers=4, printer=printer),
+
+        'equi_depth' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, equi_depth=True, printer=printer),
+
+        'row_diffs' : lambda table, size, cli, local, remote, printer :
+            general_sync(table, size, cli, local, remote, row_diffs=True, printer=printer),
+
+        'keyset_sync' : lambda table, size, cli, local, remote, printer :
+            keyset_sync(table, size, cli, local, remote, printer=printer),
+        }
+
+def parse_bench_args(desc=None):
+
+    parser = pull_arg_parser(desc)
+
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='how many rows the table starts with')
+    parser.add_argument('--width', type=int, default=100,
+                        help='how many characters of payload each row carries')
+    parser.add_argument('--sparsity', type=float, default=0.0,
+                        help='the fraction of ids to leave unused (0 for dense ids)')
+    parser.add_argument('--inserts', type=int, default=100,
+                        help='how many rows to add upstream')
+    parser.add_argument('--updates', type=int, default=100,
+                        help='how many rows to change upstream')
+    parser.add_argument('--deletes', type=int, default=100,
+                        help='how many rows to remove upstream')
+    parser.add_argument('--distribution', choices=['scattered', 'clustered'], default='scattered',
+                        help='whether the changed rows are spread across the table, or next to each other')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--interval-size', type=int, default=1000)
+    parser.add_argument('--strategies', nargs='+', choices=list(strategies), default=list(strategies))
+    parser.add_argument('--results', default='bench_results.jsonl',
+                        help='append results here, and compare against earlier results found here')
+    parser.add_argument('--label',
+                        help='a note to store with these results')
+
+    return parser.parse_args()
+
+# the part of the arguments that determines what the data looks like
+def describe_case(args):
+    return { 'rows'         : args.rows,
+             'width'        : args.width,
+             'sparsity'     : args.sparsity,
+             'inserts'      : args.inserts,
+             'updates'      : args.updates,
+             'deletes'      : args.deletes,
+             'distribution' : args.distribution,
+             'seed'         : args.seed }
+
+def random_payload(rng, width):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(width))
+
+# the same rows every time, for a given seed
+def generate_rows(rng, rows, width, sparsity):
+    id = 0
+    for _ in range(rows):
+        id += 1
+        while sparsity and rng.random() < sparsity:
+            id += 1
+        yield (id, rng.randrange(1000000), random_payload(rng, width))
+
+# drop the table and fill it with freshly generated rows
+def create_table(cursor, case, printer=Prindenter()):
+
+    show_do_query(cursor, 'drop table if exists {};'.format(table_name), printer=printer)
+    show_do_query(cursor, 'create table {} (id int not null, '
+                                           'val int not null, '
+                                           'payload varchar({}) not null, '
+                                           'primary key (id));'.format(table_name, max(case['width'], 1)),
+                  printer=printer)
+
+    insert = 'insert into {} (id, val, payload) values (%s, %s, %s)'.format(table_name)
+    rng = random.Random(case['seed'])
+    ids = []
+    chunk = []
+    for row in generate_rows(rng, case['rows'], case['width'], case['sparsity']):
+        ids.append(row[0])
+        chunk.append(row)
+        if len(chunk) == 10000:
+            cursor.executemany(insert, chunk)
+            chunk = []
+    if chunk:
+        cursor.executemany(insert, chunk)
+
+    printer("{} rows, ids 1 through {}".format(len(ids), ids[-1] if ids else 0))
+    return ids
+
+# pick `count` of the ids, either next to each other or spread out
+def choose_ids(rng, ids, count, distribution):
+    count = min(count, len(ids))
+    if distribution == 'clustered':
+        start = rng.randrange(len(ids) - count + 1)
+        return ids[start:start + count]
+    else:
+        return sorted(rng.sample(ids, count))
+
+# make the remote copy differ from the local one
+def apply_changes(cursor, case, ids, printer=Prindenter()):
+
+    # a different seed than create_table so the changes don't just repeat the rows
+    rng = random.Random(case['seed'] + 1)
+
+    changed = choose_ids(rng, ids, case['updates'] + case['deletes'], case['distribution'])
+    rng.shuffle(changed)
+    updated = changed[:case['updates']]
+    deleted = changed[case['updates']:]
+
+    update = 'update {} set val = %s, payload = %s where id = %s'.format(table_name)
+    cursor.executemany(update, [ (rng.randrange(1000000), random_payload(rng, case['width']), id)
+                                 for id in updated ])
+
+    if deleted:
+        cursor.executemany('delete from {} where id = %s'.format(table_name), [ (id,) for id in deleted ])
+
+    start = ids[-1] + 1 if ids else 1
+    insert = 'insert into {} (id, val, payload) values (%s, %s, %s)'.format(table_name)
+    cursor.executemany(insert, [ (start + i, rng.randrange(1000000), random_payload(rng, case['width']))
+                                 for i in range(case['inserts']) ])
+
+    printer("updated {}, deleted {}, inserted {} rows upstream".format(len(updated), len(deleted),
+                                                                       case['inserts']))
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# set up both sides, then sync them with one strategy and note what it cost
+def run_case(name, args, local_args, remote_args, printer=Prindenter()):
+
+    case = describe_case(args)
+
+    printer("[Building table {} on both sides]".format(table_name))
+    with Indent(printer):
+        with LocalConnection(local_args) as local_connection:
+            with local_connection.cursor() as local_cursor:
+                create_table(local_cursor, case, printer=printer)
+        with RemoteConnection(remote_args) as remote_connection:
+            with remote_connection.cursor() as remote_cursor:
+                ids = create_table(remote_cursor, case, printer=printer)
+                apply_changes(remote_cursor, case, ids, printer=printer)
+
+    printer("[Syncing with {}]".format(name))
+    with Indent(printer):
+        metrics.reset()
+        with RemoteConnection(remote_args) as remote_connection:
+            started = time.monotonic()
+            with metrics.table(table_name):
+                strategies[name](table_name, args.interval_size, args, local_args, remote_connection,
+                                 printer)
+            seconds = time.monotonic() - started
+
+            with LocalConnection(local_args) as local_connection:
+                with local_connection.cursor() as local_cursor:
+                    with remote_connection.cursor() as remote_cursor:
+                        equal = checksums_match(remote_cursor, local_cursor, table_name, printer=printer)
+
+    totals = metrics.totals(table_name)
+    return { 'time'          : time.strftime('%Y-%m-%dT%H:%M:%S'),
+             'revision'      : git_revision(),
+             'label'         : args.label,
+             'case'          : case,
+             'strategy'      : name,
+             'interval_size' : args.interval_size,
+             'seconds'       : seconds,
+             'equal'         : equal,
+             'counts'        : totals }
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return [ json.loads(line) for line in f if line.strip() ]
+    except FileNotFoundError:
+        return []
+
+# the latest earlier result for the same data, strategy, and interval size
+def find_previous(results, result):
+    for earlier in reversed(results):
+        if (earlier['case'] == result['case'] and
+            earlier['strategy'] == result['strategy'] and
+            earlier['interval_size'] == result['interval_size']):
+            return earlier
+
+def change(now, before):
+    if not before:
+        return ''
+    return ' ({:+.0%})'.format((now - before) / before)
+
+def summarize(result, previous):
+    counts = result['counts']
+    before = previous['counts'] if previous else {}
+    fields = [ ('seconds', result['seconds'], previous and previous['seconds']) ]
+    fields += [ (name, counts.get(name, 0), before.get(name, 0))
+                for name in ('queries', 'dumped_bytes', 'loaded_bytes') ]
+
+    line = '{:<14}'.format(result['strategy'])
+    line += '  '.join('{} {:.6g}{}'.format(name, now, change(now, was)) for name, now, was in fields)
+    if not result['equal']:
+        line += '  NOT IN SYNC'
+    if previous:
+        line += '  vs {} ({})'.format(previous['time'], previous['revision'])
+    return line
+
+def main(args):
+    printer = Prindenter(indent=0, verbosity=getattr(args, 'verbosity', INFO))
+
+    local_args = LocalArgs(args.local_user, args.local_password, args.local_database, args.local_socket)
+    remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password,
+                             args.remote_database, cipher=args.cipher, port=args.remote_port)
+
+    earlier = load_results(args.results)
+    results = []
+    for name in args.strategies:
+        printer("[Benchmark: {}]".format(name))
+        with Indent(printer):
+            result = run_case(name, args, local_args, remote_args, printer=printer)
+        results.append(result)
+
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    printer("[Results, also in {}]".format(args.results), level=QUIET)
+    with Indent(printer):
+        for result in results:
+            printer(summarize(result, find_previous(earlier, result)), level=QUIET)
+
+# used as entrypoint in setup.py
+def bench():
+    main(parse_bench_args('time each sync strategy against a synthetic table'))
+
+# called when this script is run directly
+if __name__ == '__main__':
+    bench()
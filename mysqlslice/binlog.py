@@ -0,0 +1,152 @@
+from mysqlslice.cli import Prindenter, Indent, show_do_query
+from mysqlslice.mysql import LocalConnection
+from mysqlslice.state import load_state, save_state
+from mysqlslice.keyset import get_primary_key
+from mysqlslice.sync import general_sync
+from mysqlslice.metrics import metrics
+from mysqlslice.transfer import quoted
+
+# Binlog Tailing
+# ==============
+
+# The other strategies work out what changed by looking at table contents.  This one reads the remote
+# server's (row based) binlog instead, so its cost depends on how much changed, not on how big the tables are.
+#
+# It needs the mysql-replication package:  pip install mysqlslice[binlog]
+# and the remote server needs binlog_format=ROW and binlog_row_image=FULL
+# (also binlog_row_metadata=FULL for mysql-replication >= 1.0, which no longer looks up column names itself)
+
+# where the remote server is writing its binlog right now
+def get_binlog_position(cursor, printer=Prindenter()):
+    try:
+        result = show_do_query(cursor, 'show master status;', printer=printer)
+    except Exception:
+        # renamed in 8.4
+        result = show_do_query(cursor, 'show binary log status;', printer=printer)
+
+    if not result:
+        raise ValueError("{} isn't writing a binlog".format(cursor.connection.host))
+    return { 'file' : result[0]['File'], 'position' : result[0]['Position'] }
+
+# Applies the INSERTs, UPDATEs and DELETEs on table_names since the last run, a transaction at a time.
+# The position is saved (in .mysqlslice/) after each batch of at least batch_events row events is committed.
+# If there is no saved position, or the binlog it points to has been purged,
+# each table gets a general_sync (with interval_size) instead and tailing starts from the current position.
+@metrics.phase('tail_binlog')
+def tail_binlog(table_names, cli_args, local_args, remote_connection, server_id=4242, batch_events=1000,
+                interval_size=1000, printer=Prindenter()):
+
+    try:
+        from pymysqlreplication import BinLogStreamReader
+        from pymysqlreplication.event import XidEvent
+        from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+    except ImportError:
+        raise ImportError("tail_binlog needs the mysql-replication package, try: pip install mysqlslice[binlog]")
+
+    names = ('binlog', local_args.database, '+'.join(sorted(table_names)))
+    state = load_state(*names)
+
+    with remote_connection.cursor() as cursor:
+        printer("[Finding binlog position on {}]".format(cursor.connection.host))
+        with Indent(printer):
+            current = get_binlog_position(cursor, printer=printer)
+            available = [ row['Log_name'] for row in show_do_query(cursor, 'show binary logs;', printer=printer) ]
+
+    if not state or state['file'] not in available:
+
+        if state:
+            printer("{} has been purged, falling back to general_sync".format(state['file']))
+        else:
+            printer("No binlog position for {} yet, starting with general_sync".format(', '.join(table_names)))
+
+        # changes made during these syncs get replayed next time, which is harmless
+        with Indent(printer):
+            for table_name in table_names:
+                general_sync(table_name, interval_size, cli_args, local_args, remote_connection, printer=printer)
+
+        save_state(current, *names)
+        return
+
+    # the same server, port, and ssl settings as RemoteConnection
+    args = remote_connection.args
+    settings = { 'host'   : args.host,
+                 'port'   : args.port,
+                 'user'   : args.user,
+                 'passwd' : args.password }
+    if args.cipher != None:
+        settings['ssl'] = { 'cipher' : args.cipher }
+
+    stream = BinLogStreamReader(connection_settings=settings,
+                                server_id=server_id,
+                                log_file=state['file'],
+                                log_pos=state['position'],
+                                resume_stream=True,
+                                blocking=False,
+                                only_schemas=[args.database],
+                                only_tables=table_names,
+                                only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent])
+
+    printer("[Applying binlog events for {} from {}:{}]".format(', '.join(table_names),
+                                                               state['file'],
+                                                               state['position']))
+    with Indent(printer), LocalConnection(local_args) as local_connection:
+        with local_connection.cursor() as cursor:
+
+            keys = { table_name : get_primary_key(cursor, table_name, printer=printer) for table_name in table_names }
+
+            def replace(table_name, values):
+                columns = list(values)
+                cursor.execute('REPLACE INTO {} ({}) VALUES ({});'.format(table_name,
+                                                                         quoted(columns),
+                                                                         ', '.join(['%s'] * len(columns))),
+                               [ values[column] for column in columns ])
+
+            def delete(table_name, values):
+                key = keys[table_name]
+                cursor.execute('DELETE FROM {} WHERE {};'.format(table_name,
+                                                                ' AND '.join('`{}` = %s'.format(column)
+                                                                             for column in key)),
+                               [ values[column] for column in key ])
+
+            applied = 0
+            in_batch = 0
+            local_connection.connection.begin()
+            try:
+                for event in stream:
+
+                    if isinstance(event, XidEvent):
+                        # only stop at transaction boundaries, so the saved position is never mid-transaction
+                        if in_batch >= batch_events:
+                            local_connection.connection.commit()
+                            save_state({ 'file' : stream.log_file, 'position' : stream.log_pos }, *names)
+                            printer("{} row events applied, now at {}:{}".format(applied,
+                                                                               stream.log_file,
+                                                                               stream.log_pos))
+                            in_batch = 0
+                            local_connection.connection.begin()
+                        continue
+
+                    for row in event.rows:
+                        if isinstance(event, WriteRowsEvent):
+                            replace(event.table, row['values'])
+                        elif isinstance(event, UpdateRowsEvent):
+                            # the key itself might have changed
+                            if any(row['before_values'][column] != row['after_values'][column]
+                                   for column in keys[event.table]):
+                                delete(event.table, row['before_values'])
+                            replace(event.table, row['after_values'])
+                        elif isinstance(event, DeleteRowsEvent):
+                            delete(event.table, row['values'])
+                        applied += 1
+                        in_batch += 1
+                        metrics.count(row_events=1)
+
+                local_connection.connection.commit()
+                save_state({ 'file' : stream.log_file, 'position' : stream.log_pos }, *names)
+            except:
+                local_connection.connection.rollback()
+                raise
+            finally:
+                stream.close()
+
+    printer("{} row events applied, caught up at {}:{}".format(applied, stream.log_file, stream.log_pos))
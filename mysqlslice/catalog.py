@@ -0,0 +1,167 @@
+import hashlib
+import threading
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG, show_do_query
+from mysqlslice.state import load_state, save_state
+
+# Schema Catalog
+# ==============
+
+# information_schema queries are slow on servers with lots of tables, and asking once per table
+# (per side, per strategy) adds up.  So the columns, keys, and size estimates for every table in
+# a database are loaded in bulk, once per server per run, and everything reads from that:
+#
+#     catalog = get_catalog(cursor)
+#     catalog.columns('bar')        # rows like information_schema.columns, in ordinal order
+#     catalog.primary_key('bar')    # ['id']
+#     catalog.indexes('bar')        # rows like information_schema.statistics
+#     catalog.estimate('bar')       # {'rows' : ..., 'bytes' : ...}, as of the last ANALYZE
+#
+# With catalogs.on_disk (--cache-catalog), columns and indexes are also kept in .mysqlslice/ and reused
+# until the schema version changes: any table created, dropped, or rebuilt, or any column or index
+# added, dropped, renamed, moved, or retyped (instant ALTERs don't change CREATE_TIME, so the
+# columns and indexes are hashed too).  Size estimates are always fresh.
+
+class Catalog:
+    def __init__(self, host, database):
+        self.host = host
+        self.database = database
+        self.tables = {}
+
+    def load(self, cursor, on_disk=False, printer=Prindenter()):
+
+        printer("[Loading the schema catalog for {}.{}]".format(self.host, self.database), level=DEBUG)
+        with Indent(printer):
+
+            # this doubles as the schema version
+            result = show_do_query(cursor,
+                    """
+                    SELECT TABLE_NAME, CREATE_TIME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH
+                    FROM information_schema.tables
+                    WHERE table_schema='{}'
+                    ORDER BY TABLE_NAME;
+                    """.format(self.database),
+                    printer=printer)
+
+            shapes = {}
+            if on_disk:
+                shapes = self.shapes(cursor, printer=printer)
+            version = hashlib.md5(repr([ (row['TABLE_NAME'], str(row['CREATE_TIME']), shapes.get(row['TABLE_NAME']))
+                                         for row in result ]).encode()).hexdigest()
+
+            self.tables = { row['TABLE_NAME'] : { 'columns' : [],
+                                                  'indexes' : [],
+                                                  'estimate' : { 'rows'  : row['TABLE_ROWS'],
+                                                                 'bytes' : row['DATA_LENGTH'] } }
+                            for row in result }
+
+            names = ('catalog', self.host, self.database)
+            cached = load_state(*names) if on_disk else None
+            if cached and cached['version'] == version:
+                printer("schema version {} hasn't changed, using the catalog in .mysqlslice/".format(version),
+                        level=DEBUG)
+                for table_name, table in cached['tables'].items():
+                    if table_name in self.tables:
+                        self.tables[table_name].update(table)
+                return self
+
+            columns = show_do_query(cursor,
+                    """
+                    SELECT TABLE_NAME, COLUMN_NAME, IS_NULLABLE, DATA_TYPE, COLUMN_TYPE, COLLATION_NAME
+                    FROM information_schema.columns
+                    WHERE table_schema='{}'
+                    ORDER BY TABLE_NAME, ORDINAL_POSITION;
+                    """.format(self.database),
+                    printer=printer)
+
+            indexes = show_do_query(cursor,
+                    """
+                    SELECT TABLE_NAME, INDEX_NAME, COLUMN_NAME, SEQ_IN_INDEX, SUB_PART, NON_UNIQUE, INDEX_TYPE
+                    FROM information_schema.statistics
+                    WHERE table_schema='{}'
+                    ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX;
+                    """.format(self.database),
+                    printer=printer)
+
+            for row in columns:
+                if row['TABLE_NAME'] in self.tables:
+                    self.tables[row['TABLE_NAME']]['columns'].append(row)
+            for row in indexes:
+                if row['TABLE_NAME'] in self.tables:
+                    self.tables[row['TABLE_NAME']]['indexes'].append(row)
+
+            if on_disk:
+                save_state({ 'version' : version,
+                             'tables'  : { table_name : { 'columns' : table['columns'],
+                                                          'indexes' : table['indexes'] }
+                                           for table_name, table in self.tables.items() } },
+                           *names)
+
+        return self
+
+    # a hash of each table's columns and indexes, computed on the server so only one row per table comes back
+    # (BIT_XOR because GROUP_CONCAT would get cut off at group_concat_max_len)
+    def shapes(self, cursor, printer=Prindenter()):
+        shapes = {}
+        for source, fields in [ ('columns',    'COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, IS_NULLABLE, COLLATION_NAME'),
+                                ('statistics', 'INDEX_NAME, COLUMN_NAME, SEQ_IN_INDEX, SUB_PART, NON_UNIQUE, INDEX_TYPE') ]:
+            result = show_do_query(cursor,
+                    """
+                    SELECT TABLE_NAME, BIT_XOR(CAST(CONV(LEFT(MD5(CONCAT_WS(':', {})), 16), 16, 10) AS UNSIGNED)) AS shape
+                    FROM information_schema.{}
+                    WHERE table_schema='{}'
+                    GROUP BY TABLE_NAME;
+                    """.format(fields, source, self.database),
+                    printer=printer)
+            for row in result:
+                shapes.setdefault(row['TABLE_NAME'], []).append(str(row['shape']))
+        return shapes
+
+    def table(self, table_name):
+        if table_name not in self.tables:
+            raise KeyError("{}.{} has no table named {}".format(self.host, self.database, table_name))
+        return self.tables[table_name]
+
+    def columns(self, table_name):
+        return self.table(table_name)['columns']
+
+    def indexes(self, table_name):
+        return self.table(table_name)['indexes']
+
+    def primary_key(self, table_name):
+        return [ row['COLUMN_NAME'] for row in self.indexes(table_name) if row['INDEX_NAME'] == 'PRIMARY' ]
+
+    def estimate(self, table_name):
+        return self.table(table_name)['estimate']
+
+# one catalog per server and database, shared by every step (and thread) in the run
+class Catalogs:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.catalogs = {}
+
+        # keep columns and indexes between runs too
+        self.on_disk = False
+
+    def get(self, cursor, printer=Prindenter()):
+        key = (cursor.connection.host, cursor.connection.db)
+        with self.lock:
+            if key not in self.catalogs:
+                self.catalogs[key] = Catalog(*key).load(cursor, on_disk=self.on_disk, printer=printer)
+            return self.catalogs[key]
+
+    # for tables that were created after the catalog was loaded
+    def refresh(self, cursor, printer=Prindenter()):
+        key = (cursor.connection.host, cursor.connection.db)
+        with self.lock:
+            self.catalogs[key] = Catalog(*key).load(cursor, on_disk=self.on_disk, printer=printer)
+            return self.catalogs[key]
+
+catalogs = Catalogs()
+
+# the catalog for this cursor's server, reloaded if it doesn't know about table_name yet
+def get_catalog(cursor, table_name=None, printer=Prindenter()):
+    catalog = catalogs.get(cursor, printer=printer)
+    if table_name and table_name not in catalog.tables:
+        catalog = catalogs.refresh(cursor, printer=printer)
+    return catalog
@@ -1,17 +1,31 @@
+import io
 import sys
 import textwrap
 import argparse
 import subprocess
 import os
 import re
+import time
+import shlex
 from pprint import pformat
+from concurrent.futures import ThreadPoolExecutor
 from sh import bash, awk, netstat, mysql
 from mysqlslice.mysql import LocalArgs, RemoteArgs
+from mysqlslice.math import Interval
+from mysqlslice.spool import Spool
+from mysqlslice.state import state_dir
+from mysqlslice.metrics import metrics
+from mysqlslice.throttle import throttle
+from mysqlslice.fanout import shared
 
 # Parsing Command Line Aguments
 # =============================
 
 def parse_pull_args(desc=None):
+    return pull_arg_parser(desc).parse_args()
+
+# the arguments that every command takes, for commands that need to add more
+def pull_arg_parser(desc=None):
 
     parser = argparse.ArgumentParser(description=desc,
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -46,24 +60,68 @@ def parse_pull_args(desc=None):
     parser.add_argument('-u', '--remote-user',     default=dr_user)
     parser.add_argument('-p', '--remote-password', default=dr_password)
     parser.add_argument('-o', '--remote-host',     default=dr_host)
+    parser.add_argument('-P', '--remote-port',     default=3306, type=int)
     parser.add_argument('-d', '--remote-database', default=dr_database)
     parser.add_argument('-c', '--cipher')
-
-    return parser.parse_args()
+    parser.add_argument('--verify-local', action='store_true',
+                        help='hash the local side even if cached fingerprints are available')
+    parser.add_argument('-v', '--verbose', dest='verbosity', action='store_const', const=DEBUG, default=INFO,
+                        help='show every query and command, and what came back')
+    parser.add_argument('-q', '--quiet', dest='verbosity', action='store_const', const=QUIET,
+                        help='only show warnings')
+    parser.add_argument('--metrics-file', default=os.path.join(state_dir, 'metrics.json'),
+                        help='where to write timings and counts for each table and phase')
+    parser.add_argument('--profile',
+                        help='profile each table and phase with cProfile, saving the results in this directory')
+    parser.add_argument('--verify', choices=['none', 'sampled', 'incremental', 'full'], default='incremental',
+                        help='how hard to check each table after syncing it (see verify.py)')
+    parser.add_argument('--transfer', choices=['dump', 'stream'], default='dump',
+                        help='move rows with mysqldump and mysql (dump), or over the existing connections (stream)')
+    parser.add_argument('--cache-catalog', action='store_true',
+                        help='keep each server\'s column and index metadata in .mysqlslice/ until its schema changes')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='how many tables to sync at once')
+    parser.add_argument('--max-threads-running', type=int,
+                        help='back off while the remote server has more than this many threads running')
+    parser.add_argument('--max-replica-lag', type=int,
+                        help='back off while the remote server (if it is a replica) is this many seconds behind')
+    parser.add_argument('--max-query-seconds', type=float,
+                        help='back off when a remote fingerprint query takes longer than this')
+    parser.add_argument('--max-bytes-per-second', type=int,
+                        help='dump no faster than this')
+    parser.add_argument('--max-remote-ops', type=int,
+                        help='run at most this many queries or dumps on the remote server at once, across all jobs')
+    parser.add_argument('--also-into', nargs='+', default=[], metavar='LOCAL_DATABASE',
+                        help='sync into these local databases too, reading from the remote server only once')
+
+    return parser
 
 # Printing Messages to the Caller
 # ===============================
 
+# verbosity levels: a message is printed if its level is at or below the printer's verbosity
+QUIET = 0    # warnings only
+INFO = 1     # what's happening, table by table
+DEBUG = 2    # every query and command, and what came back
+
 # print status to stderr so that only the requested value is written to stdout
 # (the better for consumption by a caller in code)
 # default to a four-space indent
+# msg may be a function, in which case it's only called if the message is going to be printed
 class Prindenter:
-    def __init__(self, indent=4, file=sys.stderr):
+    def __init__(self, indent=4, file=sys.stderr, verbosity=DEBUG):
         self.indent = indent
         self.at_line_begin = True
         self.file = file
+        self.verbosity = verbosity
+
+    def __call__(self, msg, end='\n', level=INFO):
 
-    def __call__(self, msg, end='\n'):
+        if level > self.verbosity:
+            return
+
+        if callable(msg):
+            msg = msg()
 
         if self.at_line_begin:
             this_indent = self.indent
@@ -77,6 +135,29 @@ class Prindenter:
 
         print(textwrap.indent(msg.__str__(), ' ' * this_indent), file=self.file, end=end)
 
+# for use in worker threads: holds output until replay() so that it doesn't interleave with other threads
+# each message is kept with its level, so it's replayed at that level (and a -q printer still shows warnings)
+class BufferedPrindenter(Prindenter):
+    def __init__(self, indent=0, verbosity=DEBUG):
+        super().__init__(indent=indent, file=io.StringIO(), verbosity=verbosity)
+        self.messages = []
+
+    def __call__(self, msg, end='\n', level=INFO):
+        if level > self.verbosity:
+            return
+
+        start = self.file.tell()
+        super().__call__(msg, end=end, level=level)
+        self.file.seek(start)
+        self.messages.append((level, self.file.read()))
+
+    def replay(self, printer):
+        for level, text in self.messages:
+            if text.endswith('\n'):
+                printer(text[:-1], level=level)
+            else:
+                printer(text, end='', level=level)
+
 # Increments the intent depth for a Prindenter
 class Indent:
     def __init__(self, printer):
@@ -92,25 +173,56 @@ class Indent:
 # Executing External Commands
 # ===========================
 
-# print a bash command and its result
+# how much of a result is worth showing in full
+show_rows = 10
+show_bytes = 1000
+
+def summarize_output(result, elapsed):
+    text = str(result)
+    if len(text) > show_bytes:
+        return "{} bytes of output in {:.3f}s".format(len(text), elapsed)
+    return "{}\n({:.3f}s)".format(repr(result), elapsed)
+
+def summarize_result(result, elapsed):
+    if hasattr(result, '__len__') and len(result) > show_rows:
+        return "{} rows in {:.3f}s".format(len(result), elapsed)
+    return "{}\n({:.3f}s)".format(pformat(result), elapsed)
+
+# print a bash command and its result (if the printer is verbose enough)
 def run_in_bash(command,
                 run=lambda cmd : bash(['-c', cmd]),
                 printer=Prindenter()):
 
     with Indent(printer):
-        printer('[Command]')
+        printer('[Command]', level=DEBUG)
         with Indent(printer):
-            printer(command)
-        printer('[Output]')
+            printer(command, level=DEBUG)
+        printer('[Output]', level=DEBUG)
         with Indent(printer):
             # execute and print output
+            started = time.monotonic()
             result = run(command)
-            printer(repr(result))
+            elapsed = time.monotonic() - started
+            metrics.count(commands=1, command_seconds=elapsed)
+            printer(lambda : summarize_output(result, elapsed), level=DEBUG)
     return result
 
-def mysqldump_data_remote(slice_args, table_name, condition, append=False, printer=Prindenter()):
-
-    outfile = table_name + '.sql'
+# run a command and copy its output into outfile, no faster than the throttle allows (see throttle.py)
+def run_paced(command, outfile, append=False, chunk_size=65536):
+    with open(outfile, 'ab' if append else 'wb') as f:
+        process = subprocess.Popen(['bash', '-c', command], stdout=subprocess.PIPE)
+        for chunk in iter(lambda : process.stdout.read(chunk_size), b''):
+            f.write(chunk)
+            throttle.transferred(len(chunk))
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode, command)
+    return ''
+
+# with replace, the dump uses REPLACE instead of INSERT, so it can be loaded over existing rows
+def mysqldump_data_remote(slice_args, table_name, condition, append=False, outfile=None, replace=False,
+                          printer=Prindenter()):
+
+    outfile = outfile or table_name + '.sql'
     printer('[Dumping {} from {}.{} where {} into {}/{}]'.format(table_name,
                                                                  slice_args.remote_host,
                                                                  slice_args.remote_database,
@@ -119,9 +231,9 @@ def mysqldump_data_remote(slice_args, table_name, condition, append=False, print
                                                                  outfile))
 
     # build command string
+    # conditions on string keys have quotes in them
     format_args = { 'table'     : table_name,
-                    'condition' : condition,
-                    'file'      : outfile }
+                    'condition' : shlex.quote(condition) }
 
     # if batch processing, append to file instead of making a new one
     if append:
@@ -133,6 +245,7 @@ def mysqldump_data_remote(slice_args, table_name, condition, append=False, print
     command = ' '.join(['mysqldump',
                         '--compress',
                         '-h{remote_host}',
+                        '-P{remote_port}',
                         '-u{remote_user}',
                         '-p{remote_password}',
                         '{remote_database}',
@@ -140,46 +253,102 @@ def mysqldump_data_remote(slice_args, table_name, condition, append=False, print
                         '--no-create-info',
                         '--lock-tables=false',
                         '--set-gtid-purged=OFF',
-                        '--where=\'{condition}\'',
-                        redirect, '{file}',
+                        '--where={condition}',
+                        '--replace' if replace else '',
                        ]
                       ).format(**format_args)
 
-    return run_in_bash(command, printer=printer)
+    # with --max-bytes-per-second, the dump is read through a pipe at that pace instead of redirected
+    if throttle.max_bytes_per_second:
+        run = lambda cmd : run_paced(cmd, outfile, append=append)
+    else:
+        run = lambda cmd : bash(['-c', cmd])
+        command = ' '.join([command, redirect, outfile])
+
+    # another target already dumped this (see fanout.py)
+    if shared.reuse_dump(table_name, condition, replace, outfile, append=append):
+        printer('(dumped already, for another target)')
+        metrics.count(shared_dumps=1)
+        return
+
+    before = os.path.getsize(outfile) if append and os.path.exists(outfile) else 0
+    with throttle.remote(observe=False):
+        result = run_in_bash(command, run=run, printer=printer)
+    metrics.count(dumps=1, dumped_bytes=os.path.getsize(outfile) - before)
+    shared.keep_dump(table_name, condition, replace, outfile, start=before)
+    return result
 
-# split a dump in pieces to avoid connection timeout issues
-def mysqldump_data_remote_batches(slice_args, table_name, batch_size, max_id,
-                                  min_id=0, condition=None, printer=Prindenter()):
+# batches line up on multiples of batch_size so that reruns ask for the same ones
+def plan_batches(batch_size, max_id, min_id=0):
+    first = min_id - min_id % batch_size
+    return [ Interval(max(x, min_id), x + batch_size - 1) for x in range(first, max_id + 1, batch_size) ]
 
-    boundaries = list(range(min_id, max_id, batch_size))
-    intervals = [ (x, x + batch_size - 1) for x in boundaries ]
+# dump one batch into the spool, unless an earlier attempt already did
+def mysqldump_data_remote_batch(slice_args, table_name, spool, interval, condition=None, printer=Prindenter()):
 
-    printer("[Dump proceeding across {} batches]".format(len(intervals)))
-    with Indent(printer):
+    # modify the condition for a smaller dump
+    if condition:
+        restricted_condition = condition + " and id >= {} and id <= {}".format(interval.start, interval.end)
+    else:
+        restricted_condition = "id >= {} and id <= {}".format(interval.start, interval.end)
 
-        first_batch = True
-        for interval in intervals:
+    if spool.is_dumped(interval, restricted_condition):
+        printer("[Batch {} was spooled by an earlier attempt, skipping it]".format(interval))
+        return
 
-            # modify the condition for a smaller dump
-            if condition:
-                restricted_condition = condition + " and id >= {} and id <= {}".format(interval[0], interval[1])
-            else:
-                restricted_condition = "id >= {} and id <= {}".format(interval[0], interval[1])
-
-            # dump in append mode for all but first batch
-            if first_batch:
-                first_batch = False
-                mysqldump_data_remote(slice_args,
-                                      table_name,
-                                      restricted_condition,
-                                      printer=printer)
-            else:
-                mysqldump_data_remote(slice_args,
-                                      table_name,
-                                      restricted_condition,
-                                      append=True,
-                                      printer=printer)
+    mysqldump_data_remote(slice_args,
+                          table_name,
+                          restricted_condition,
+                          outfile=spool.file_for(interval),
+                          printer=printer)
+    spool.dumped(interval, restricted_condition)
 
+# split a dump in pieces to avoid connection timeout issues
+# each batch is spooled to its own file (see spool.py), so if this gets interrupted,
+# a rerun only dumps the batches that didn't make it to disk (or load).
+# Up to `workers` batches are dumped at once, and each batch is loaded as soon as it (and every batch
+# before it) is on disk.  Loading in order means that an interruption leaves no gaps below the local max(id).
+def pull_batches(slice_args, table_name, batch_size, max_id, min_id=0, condition=None, workers=1,
+                 printer=Prindenter()):
+
+    intervals = plan_batches(batch_size, max_id, min_id=min_id)
+
+    spool = Spool(table_name, slice_args.local_database)
+    spool.keep_only(intervals)
+
+    # runs in a worker thread, so it gets its own printer (and borrows this thread's metrics context)
+    context = metrics.context()
+    def dump(interval):
+        buffer = BufferedPrindenter(verbosity=printer.verbosity)
+        with metrics.adopt(context):
+            mysqldump_data_remote_batch(slice_args, table_name, spool, interval, condition=condition,
+                                        printer=buffer)
+        return buffer
+
+    printer("[Pulling {} batches, dumping {} at a time]".format(len(intervals), workers))
+    with Indent(printer), ThreadPoolExecutor(max_workers=workers) as executor:
+
+        futures = [ executor.submit(dump, interval) for interval in intervals ]
+        try:
+            for number, (interval, future) in enumerate(zip(intervals, futures), start=1):
+
+                # later batches keep downloading while this one loads
+                future.result().replay(printer)
+
+                if spool.is_loaded(interval):
+                    printer("[Batch {} was loaded by an earlier attempt, skipping it]".format(interval))
+                else:
+                    mysqlload_local(slice_args, spool.file_for(interval), printer=printer)
+                    spool.loaded(interval)
+
+                printer("[Batch {}/{} ({}, {} bytes) is in]".format(number, len(intervals), interval,
+                                                                   spool.bytes(interval)))
+        except:
+            for future in futures:
+                future.cancel()
+            raise
+
+    spool.clear()
 
 def mysqldump_schema_nofk_remote(slice_args, outfile, printer=Prindenter()):
 
@@ -200,6 +369,7 @@ def mysqldump_schema_nofk_remote(slice_args, outfile, printer=Prindenter()):
     format_args.update(slice_args.__dict__) # use key-names from argparse
     command = ' '.join(['mysqldump',
                         '-h{remote_host}',
+                        '-P{remote_port}',
                         '-u{remote_user}',
                         '-p{remote_password}',
                         '{remote_database}',
@@ -218,7 +388,8 @@ def mysqldump_schema_nofk_remote(slice_args, outfile, printer=Prindenter()):
     return run_in_bash(command, printer=printer)
 
 
-def mysqlload_local(slice_args, table_or_file_name, printer=Prindenter()):
+# if into_table is given, the dump of table_name gets loaded into that table instead
+def mysqlload_local(slice_args, table_or_file_name, into_table=None, printer=Prindenter()):
 
     # derive file name if table name was provided
     if re.match(r'.*\.sql$', table_or_file_name):
@@ -228,20 +399,34 @@ def mysqlload_local(slice_args, table_or_file_name, printer=Prindenter()):
 
     printer('[Loading {} from {} into {}]'.format(infile,
                                                  '{}/{}'.format(os.getcwd(), infile),
-                                                 slice_args.local_database))
+                                                 slice_args.local_database
+                                                 + ('.' + into_table if into_table else '')))
     # build command string
     format_args =  { 'file' : infile }
     format_args.update(slice_args.__dict__) # use key-names from argparse
-    command = ' '.join(['mysql',
-                        '-u{local_user}',
-                        '-p{local_password}',
-                        '-D{local_database}',
-                        '-e\'source {file};\'',
-                       ]
-                      ).format(**format_args)
+    mysql_command = ['mysql',
+                     '-u{local_user}',
+                     '-p{local_password}',
+                     '-D{local_database}']
+
+    if into_table:
+        # mysqldump only names the table at the start of its statements, so rewrite just those
+        table_name = os.path.basename(infile)[:-len('.sql')]
+        format_args.update({ 'table' : table_name, 'into' : into_table })
+        command = ' '.join(['sed',
+                            "-e 's/^INSERT INTO `{table}`/INSERT INTO `{into}`/'",
+                            "-e 's/^LOCK TABLES `{table}`/LOCK TABLES `{into}`/'",
+                            "-e 's/^\\/\\*!40000 ALTER TABLE `{table}`/\\/*!40000 ALTER TABLE `{into}`/'",
+                            '{file}',
+                            '|'] + mysql_command
+                          ).format(**format_args)
+    else:
+        command = ' '.join(mysql_command + ['-e\'source {file};\'']).format(**format_args)
 
-    return run_in_bash(command,
-                       printer=printer)
+    result = run_in_bash(command,
+                         printer=printer)
+    metrics.count(loads=1, loaded_bytes=os.path.getsize(infile))
+    return result
 
 # pretty printer for query execution
 def show_do_query(cursor,
@@ -250,14 +435,27 @@ def show_do_query(cursor,
         get=lambda cursor: cursor.fetchall(),
         printer=Prindenter()):
 
-    printer('[MySQL @ {}, database: {}]'.format(cursor.connection.host, cursor.connection.db))
+    printer(lambda : '[MySQL @ {}, database: {}]'.format(cursor.connection.host, cursor.connection.db), level=DEBUG)
     with Indent(printer):
-        printer('[Query]')
+        printer('[Query]', level=DEBUG)
         with Indent(printer):
-            printer(textwrap.dedent(query))
-            do(cursor, query)
-        printer('[Result]')
+            printer(lambda : textwrap.dedent(query), level=DEBUG)
+            started = time.monotonic()
+
+            # another target may have asked the remote server this already (see fanout.py)
+            result = shared.lookup(cursor, query)
+            if result is None:
+                do(cursor, query)
+        printer('[Result]', level=DEBUG)
         with Indent(printer):
-            result = get(cursor)
-            printer(pformat(result))
+            if result is None:
+                result = get(cursor)
+                shared.keep(cursor, query, result)
+                elapsed = time.monotonic() - started
+                metrics.count(queries=1, query_seconds=elapsed,
+                              rows=len(result) if hasattr(result, '__len__') else 0)
+            else:
+                elapsed = time.monotonic() - started
+                metrics.count(shared_reads=1)
+            printer(lambda : summarize_result(result, elapsed), level=DEBUG)
     return result
@@ -0,0 +1,139 @@
+import os
+import shutil
+import hashlib
+import threading
+
+from mysqlslice.metrics import metrics
+from mysqlslice.state import state_dir
+
+# Fan-out
+# =======
+
+# Syncing a slice into several local databases (see --also-into) shouldn't cost the remote server any
+# more than syncing it into one.  So while fanning out, whatever is read from the remote server for one
+# target is kept for the others: query results (row counts, fingerprints, rows...) by query text, and
+# dumps by table and condition.  Each target still compares and loads on its own, with its own state
+# in .mysqlslice/, but the remote server only answers each question once.
+#
+# That only works if every target asks the same questions.  So whatever decides which questions get asked
+# (the interval size, where intervals start and end, which ones get sampled) is planned once per table,
+# from the remote side, and handed to every target with plan().  Everything local to a target (i.e.
+# its own rows beyond what the remote side has) is left to the target.
+#
+# What's kept belongs to the table being synced (the one from metrics.table(), which worker threads adopt)
+# and is forgotten once that table is in every target.  Until then the remote side is a snapshot,
+# so every target ends up with the same rows.
+#
+#     shared.watch(remote_args)
+#     with metrics.table('bar'):
+#         for local_args in targets:
+#             general_sync('bar', ...)      # only the first target's queries and dumps reach the remote server
+#     shared.forget('bar')
+#
+#     intervals = shared.plan('intervals', lambda : plan_equi_depth(...))   # in general_sync, once for all targets
+
+# queries whose results can be shared, the rest run every time (i.e. SET SESSION)
+shared_queries = ('select', 'show', 'checksum')
+
+class SharedReads:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remote = None
+        self.results = {}
+        self.dumps = {}
+        self.plans = {}
+
+    # share reads from this server (RemoteArgs), or stop sharing with None
+    def watch(self, remote_args):
+        self.remote = (remote_args.host, remote_args.database) if remote_args else None
+
+    def is_remote(self, cursor):
+        return self.remote is not None and (cursor.connection.host, cursor.connection.db) == self.remote
+
+    def key(self, *parts):
+        table, _ = metrics.context()
+        return (table,) + parts
+
+    def is_shared(self, cursor, query):
+        return self.is_remote(cursor) and query.strip().lower().startswith(shared_queries)
+
+    # the result another target got for this query, or None
+    def lookup(self, cursor, query):
+        if not self.is_shared(cursor, query):
+            return None
+        with self.lock:
+            result = self.results.get(self.key(query))
+        return None if result is None else list(result)
+
+    def keep(self, cursor, query, result):
+        if self.is_shared(cursor, query):
+            with self.lock:
+                self.results[self.key(query)] = list(result)
+
+    # copy the dump another target got into outfile (or onto the end of it), False if there isn't one
+    def reuse_dump(self, table_name, condition, replace, outfile, append=False):
+        if self.remote is None:
+            return False
+
+        with self.lock:
+            kept = self.dumps.get(self.key(table_name, condition, replace))
+        if not kept or not os.path.exists(kept):
+            return False
+
+        with open(kept, 'rb') as source, open(outfile, 'ab' if append else 'wb') as target:
+            shutil.copyfileobj(source, target)
+        return True
+
+    # keep a copy of what was just dumped into outfile (from byte `start` on, if it was appended)
+    def keep_dump(self, table_name, condition, replace, outfile, start=0):
+        if self.remote is None:
+            return
+
+        key = self.key(table_name, condition, replace)
+        directory = os.path.join(state_dir, 'shared')
+        os.makedirs(directory, exist_ok=True)
+        kept = os.path.join(directory, hashlib.md5(repr(key).encode()).hexdigest() + '.sql')
+
+        with open(outfile, 'rb') as source, open(kept, 'wb') as target:
+            source.seek(start)
+            shutil.copyfileobj(source, target)
+
+        with self.lock:
+            self.dumps[key] = kept
+
+    # the plan called `name` that another target made for this table, or make()'s if this is the first
+    # (while not fanning out, it's always make()'s)
+    def plan(self, name, make):
+        if self.remote is None:
+            return make()
+
+        key = self.key(name)
+        with self.lock:
+            if key in self.plans:
+                return self.plans[key]
+
+        made = make()
+        with self.lock:
+            self.plans[key] = made
+        return made
+
+    # has another target made this plan already?
+    def planned(self, name):
+        if self.remote is None:
+            return False
+        with self.lock:
+            return self.key(name) in self.plans
+
+    # this table is in every target, so drop what was kept for it
+    def forget(self, table_name):
+        with self.lock:
+            for key in [ key for key in self.plans if key[0] == table_name ]:
+                del self.plans[key]
+            for key in [ key for key in self.results if key[0] == table_name ]:
+                del self.results[key]
+            for key in [ key for key in self.dumps if key[0] == table_name ]:
+                path = self.dumps.pop(key)
+                if os.path.exists(path):
+                    os.remove(path)
+
+shared = SharedReads()
@@ -0,0 +1,344 @@
+import json
+import hashlib
+from bisect import bisect_left
+from math import floor
+
+from mysqlslice.cli import Prindenter, Indent, show_do_query, DEBUG
+from mysqlslice.state import load_state, save_state
+from mysqlslice.catalog import get_catalog
+from mysqlslice.throttle import throttle
+
+# Column Policies
+# ===============
+
+# column types that can be big enough to be worth hashing on their own
+large_types = ['tinytext', 'text', 'mediumtext', 'longtext',
+               'tinyblob', 'blob', 'mediumblob', 'longblob',
+               'json']
+
+# Which columns of a table get compared, and how.  Pass one to a strategy as policy=...
+#   exclude       leave these out of the comparison (i.e. a last_seen that changes all the time)
+#   only          compare just these (i.e. 'version' or 'updated_at'), the rest come along when a row is copied
+#   digest        hash these on their own first, so CONCAT handles 32 bytes per row instead of the whole value
+#   digest_large  digest every TEXT, BLOB, and JSON column too
+#   digest_with   'MD5', or 'LENGTH' if a change in content is sure to change the length (cheaper, but blinder)
+# Row-level transfers honor it too (see transfer.py): excluded columns aren't overwritten,
+# and digested columns are only sent if their digests differ.
+# The primary key is compared no matter what: without it, rows that differ only in which ids hold which
+# values (or that cancel each other out under BIT_XOR) would hash the same on either side.
+
+#     general_sync('documents', 100, ..., policy=ColumnPolicy(exclude=['last_seen'], digest_large=True))
+
+class ColumnPolicy:
+    def __init__(self, exclude=[], only=None, digest=[], digest_large=False, digest_with='MD5'):
+        self.exclude = exclude
+        self.only = only
+        self.digest = digest
+        self.digest_large = digest_large
+        self.digest_with = digest_with
+
+    # column is a row from get_columns
+    def compares(self, column):
+        name = column['COLUMN_NAME']
+        if name in self.exclude:
+            return False
+        return self.only is None or name in self.only
+
+    def digests(self, column):
+        return column['COLUMN_NAME'] in self.digest or (self.digest_large and column['DATA_TYPE'] in large_types)
+
+# the primary key columns, which every policy compares (as they are, never digested)
+def key_names(cursor, table_name, printer=Prindenter()):
+    return get_catalog(cursor, table_name, printer=printer).primary_key(table_name)
+
+# rows like information_schema.columns, in ordinal order (from the catalog, see catalog.py)
+def get_columns(cursor, table_name, printer=Prindenter()):
+    return get_catalog(cursor, table_name, printer=printer).columns(table_name)
+
+# make the column representation concatenate-friendly
+def convert_column(column, policy=ColumnPolicy()):
+
+    converted = column['COLUMN_NAME']
+
+    # a digest is plain hex (or a number), so collations don't matter
+    if policy.digests(column):
+        converted = "{}({})".format(policy.digest_with, converted)
+        if column['IS_NULLABLE'] == 'YES':
+            converted = "IFNULL({}, 'NULL')".format(converted)
+        return converted
+
+    if column['IS_NULLABLE'] == 'YES':
+        converted = "IFNULL({}, 'NULL')".format(converted)
+
+    if column['COLLATION_NAME'] and column['COLLATION_NAME'] not in ['NULL', 'utf8_general_ci']:
+        converted = "BINARY {}".format(converted)
+
+    # your data may deviate in new and exciting ways
+    # handle them here ...
+
+    return converted
+
+# not all columns can be concatenated (i.e. NULL)
+# this gets the list of columns and figures out how to make them concatenatabale
+# (leaving out or digesting some of them, according to policy)
+def examine_columns(cursor, table_name, policy=None, printer=Prindenter()):
+
+    policy = policy or ColumnPolicy()
+
+    printer("[Examining Columns on {}.{}]".format(cursor.connection.db, table_name), level=DEBUG)
+    with Indent(printer):
+        result = get_columns(cursor, table_name, printer=printer)
+        keys = key_names(cursor, table_name, printer=printer)
+
+        column_conversions= []
+
+        for column in result:
+
+            if column['COLUMN_NAME'] in keys:
+                converted = convert_column(column)
+            elif policy.compares(column):
+                converted = convert_column(column, policy)
+            else:
+                continue
+
+            with Indent(printer):
+                printer(converted, level=DEBUG)
+            column_conversions.append(converted)
+
+        return column_conversions
+
+
+# the WHERE clause for a range of ids (or for a KeyInterval, which knows its own)
+def range_condition(interval, id_col='id'):
+    if hasattr(interval, 'condition'):
+        return interval.condition()
+    return "{} >= {} AND {} <= {}".format(id_col, interval.start, id_col, interval.end)
+
+# id_col may also be several columns (i.e. 'a, b'), they're only used for ordering
+def md5_row_range(cursor, table_name, column_conversions, interval, id_col='id', printer=Prindenter()):
+
+    printer(lambda : "[Fingerprinting " + cursor.connection.db
+             + ".{} across rows where {} in {}]".format(table_name, id_col, interval), level=DEBUG)
+    with Indent(printer):
+
+        # concat-friendly conversions for the target table
+        converted_columns_str = ",".join(column_conversions)
+
+        # hash the row-range
+        condition = range_condition(interval, id_col=id_col)
+
+        result = show_do_query(cursor,
+                """
+                SELECT MD5(GROUP_CONCAT(row_fingerprints)) AS range_fingerprint from
+                    (SELECT MD5(CONCAT({})) as row_fingerprints
+                    FROM {}
+                    WHERE {}
+                    ORDER BY {}) as r;
+                """.format(converted_columns_str,
+                           table_name,
+                           condition,
+                           id_col),
+                printer=printer)
+
+        return result[0]['range_fingerprint']
+
+# row sync relies on group_concat, which silently truncates the output once it reaches
+# group_concat_max_len bytes long.
+# Interrogate the target server to see how many rows we can get away with.
+def get_max_md5_rows(cursor, try_set=1000000 * 33, printer=Prindenter()):
+    # 32 bytes for the md5 plus 1 for the comma times a million rows
+
+    # limiting it here because I'd prefer too many small queries over a few monsters
+    # that ties up the server with no gaps.  This may be unnecessarily cautious, go bigger at your own risk.
+
+    # hell, this is all at your own risk
+
+    printer("[How many rows is {} willing to hash at a time?]".format(cursor.connection.host), level=DEBUG)
+    with Indent(printer):
+
+        # try to ask for enough space for 1 million rows at a time
+        printer("Asking for lots lof space...", level=DEBUG)
+        result = show_do_query(cursor, "set session group_concat_max_len = {};".format(try_set), printer=printer)
+
+        # but accept what we're given
+        printer("Taking what we can get...", level=DEBUG)
+        result = show_do_query(cursor, "show variables where Variable_name = 'group_concat_max_len';" , printer=printer)
+        max_group_concat_bytes = int(result[0]['Value'])
+
+        # and see how many rows that is
+        printer("How many of these will fit?", level=DEBUG)
+        result = show_do_query(cursor, "select length(concat(md5('foo'),',')) as md5_bytes;" , printer=printer);
+        md5_bytes = int(result[0]['md5_bytes'])
+
+    rows = floor(max_group_concat_bytes / md5_bytes)
+    printer("{} rows".format(rows), level=DEBUG)
+    return rows
+
+# Fingerprint Engines
+# ===================
+
+# An engine knows how to hash a list of intervals on one server.
+#   batches() groups intervals into units of work (one query apiece)
+#   fingerprint() hashes a batch and returns one fingerprint per interval (None if it's empty)
+#   max_rows() is the widest interval it can hash in one go, or None if there's no limit
+
+# the original: one MD5(GROUP_CONCAT(...)) query per interval
+class GroupConcatEngine:
+
+    def batches(self, intervals):
+        for interval in intervals:
+            yield [interval]
+
+    def fingerprint(self, cursor, table_name, column_conversions, batch, id_col='id', printer=Prindenter()):
+        return [ md5_row_range(cursor, table_name, column_conversions, interval, id_col=id_col, printer=printer)
+                 for interval in batch ]
+
+    def max_rows(self, cursor, printer=Prindenter()):
+        return get_max_md5_rows(cursor, printer=printer)
+
+# one query per run of up to `buckets` contiguous intervals
+# rows hashes are combined with BIT_XOR, which doesn't care about order or group_concat_max_len
+class BucketEngine:
+    def __init__(self, buckets=1000):
+        self.buckets = buckets
+
+    # runs of contiguous intervals, so each run can be a single index-range scan
+    # (shorter runs while the remote server is busy, see throttle.py)
+    def batches(self, intervals):
+        batch = []
+        for interval in intervals:
+            if batch and (len(batch) >= throttle.scale(self.buckets) or interval.start != batch[-1].end + 1):
+                yield batch
+                batch = []
+            batch.append(interval)
+        if batch:
+            yield batch
+
+    def fingerprint(self, cursor, table_name, column_conversions, batch, id_col='id', printer=Prindenter()):
+        return md5_bucket_ranges(cursor, table_name, column_conversions, batch, id_col=id_col, printer=printer)
+
+    def max_rows(self, cursor, printer=Prindenter()):
+        return None
+
+# hash each of several contiguous intervals in a single query
+def md5_bucket_ranges(cursor, table_name, column_conversions, intervals, id_col='id', printer=Prindenter()):
+
+    start = intervals[0].start
+    end = intervals[-1].end
+
+    printer(lambda : "[Fingerprinting " + cursor.connection.db
+             + ".{} across rows where {} in {}..{}".format(table_name, id_col, start, end)
+             + " in {} buckets]".format(len(intervals)), level=DEBUG)
+    with Indent(printer):
+
+        # concat-friendly conversions for the target table
+        converted_columns_str = ",".join(column_conversions)
+
+        condition = "{id_col} >= {start} AND {id_col} <= {end}".format(**vars())
+
+        # INTERVAL(id, s1, s2, ...) is the index of the interval that contains id
+        if len(intervals) > 1:
+            bucket = "INTERVAL({}, {})".format(id_col, ", ".join(str(x.start) for x in intervals[1:]))
+        else:
+            bucket = "0"
+
+        # split each row's md5 into two 64 bit words so BIT_XOR can fold them
+        result = show_do_query(cursor,
+                """
+                SELECT {} AS bucket,
+                       COUNT(*) AS row_count,
+                       BIT_XOR(CAST(CONV(SUBSTRING(row_fingerprint, 1, 16), 16, 10) AS UNSIGNED)) AS high,
+                       BIT_XOR(CAST(CONV(SUBSTRING(row_fingerprint, 17, 16), 16, 10) AS UNSIGNED)) AS low
+                FROM
+                    (SELECT {}, MD5(CONCAT({})) AS row_fingerprint
+                    FROM {}
+                    WHERE {}) AS r
+                GROUP BY bucket;
+                """.format(bucket,
+                           id_col,
+                           converted_columns_str,
+                           table_name,
+                           condition),
+                printer=printer)
+
+        # buckets with no rows don't show up in the result
+        fingerprints = [None] * len(intervals)
+        for row in result:
+            fingerprints[int(row['bucket'])] = "{}:{:016x}{:016x}".format(row['row_count'],
+                                                                          int(row['high']),
+                                                                          int(row['low']))
+        return fingerprints
+
+# Fingerprint Cache
+# =================
+
+# Nothing but mysqlslice writes to the local copy, so its fingerprints don't change unless we change them.
+# This keeps them on disk between runs, keyed by database, table and interval.
+# If the engine, either side's column conversions, or the interval size change, the whole cache is dropped.
+# Only the intervals that this run's scan looked at are saved, so entries for boundaries that have since
+# moved (i.e. with equi_depth) don't pile up.
+# With verify=True nothing is read from the cache, the local side gets hashed and the cache is refreshed.
+class FingerprintCache:
+    def __init__(self, database, table_name, engine, columns, interval_size, id_col='id', verify=False,
+                 printer=Prindenter()):
+        self.names = ('fingerprints', database, table_name)
+        self.verify = verify
+        self.version = hashlib.md5(json.dumps([type(engine).__name__, columns, interval_size, id_col])
+                                   .encode()).hexdigest()
+        self.pending = {}
+
+        # intervals scanned this run, the rest are dropped on save()
+        self.seen = set()
+
+        stored = load_state(*self.names, default={})
+        if stored.get('version') == self.version:
+            self.fingerprints = stored['intervals']
+            printer("[Loaded {} cached fingerprints for {}.{}]".format(len(self.fingerprints), database, table_name))
+        else:
+            self.fingerprints = {}
+            if stored:
+                printer("[Table format or interval size changed, dropping cached fingerprints for {}.{}]"
+                        .format(database, table_name))
+
+    # a fingerprint for each interval, or None if any of them aren't cached
+    def lookup(self, batch):
+        if self.verify:
+            return None
+        keys = [ str(interval) for interval in batch ]
+        if all(key in self.fingerprints for key in keys):
+            return [ self.fingerprints[key] for key in keys ]
+        return None
+
+    # both sides agree, so the remote fingerprint is the local one too
+    def matched(self, interval, fingerprint):
+        self.seen.add(str(interval))
+        self.fingerprints[str(interval)] = fingerprint
+
+    # the local fingerprint is stale, but it will match this once the interval is transferred
+    def differs(self, interval, fingerprint):
+        self.seen.add(str(interval))
+        self.fingerprints.pop(str(interval), None)
+        self.pending[str(interval)] = fingerprint
+
+    # drop anything overlapping these (sorted) intervals, their rows have changed
+    def forget(self, intervals):
+        starts = [ interval.start for interval in intervals ]
+        for key in list(self.fingerprints):
+            start, end = map(int, key.split('..'))
+
+            # the last interval that starts at or before this entry ends
+            i = bisect_left(starts, end + 1) - 1
+            if i >= 0 and intervals[i].end >= start:
+                del self.fingerprints[key]
+
+    # these intervals were just copied from remote, so the local side matches the remote fingerprints now
+    def loaded(self, intervals):
+        self.forget(intervals)
+        for interval in intervals:
+            key = str(interval)
+            if key in self.pending:
+                self.fingerprints[key] = self.pending.pop(key)
+
+    def save(self):
+        self.fingerprints = { key : fingerprint for key, fingerprint in self.fingerprints.items() if key in self.seen }
+        save_state({ 'version' : self.version, 'intervals' : self.fingerprints }, *self.names)
@@ -0,0 +1,96 @@
+from pymysql.converters import escape_item
+from pymysql.cursors import SSCursor
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG
+from mysqlslice.catalog import get_catalog
+from mysqlslice.throttle import throttle
+
+# Keyset Chunking
+# ===============
+
+# Everything else assumes an integer `id` column.  For tables with composite or non-integer primary keys,
+# rows are chunked by walking the primary key instead, and chunks are described by key values.
+
+# the primary key columns, in order
+def get_primary_key(cursor, table_name, printer=Prindenter()):
+    return get_catalog(cursor, table_name, printer=printer).primary_key(table_name)
+
+# a key value (a tuple, one item per primary key column) as sql
+def key_literal(values):
+    literals = [ escape_item(value, 'utf8mb4') for value in values ]
+    if len(literals) == 1:
+        return literals[0]
+    return '(' + ', '.join(literals) + ')'
+
+def key_columns(columns):
+    if len(columns) == 1:
+        return columns[0]
+    return '(' + ', '.join(columns) + ')'
+
+# the rows whose keys are at least `start` but less than `end`
+# either may be None, which means there's no bound on that side
+class KeyInterval:
+    def __init__(self, columns, start, end):
+        self.columns = columns
+        self.start = start
+        self.end = end
+
+    def condition(self):
+        bounds = []
+        if self.start is not None:
+            bounds.append('{} >= {}'.format(key_columns(self.columns), key_literal(self.start)))
+        if self.end is not None:
+            bounds.append('{} < {}'.format(key_columns(self.columns), key_literal(self.end)))
+        return ' AND '.join(bounds) or 'TRUE'
+
+    def __repr__(self):
+        start = key_literal(self.start) if self.start is not None else '...'
+        end = key_literal(self.end) if self.end is not None else '...'
+        return "[{}, {})".format(start, end)
+
+    def __str__(self):
+        return self.__repr__()
+
+# walk the primary key (on the remote side, usually) in steps of `rows` rows
+# the first and last chunks are open ended, so together they cover every key on either side
+# the keys come from one ordered query, read with an unbuffered cursor so they arrive as the server finds them
+# (rather than costing a round trip per chunk)
+def plan_key_chunks(connection, table_name, columns, rows, printer=Prindenter()):
+
+    printer("[Planning chunks of {} rows for {} by {}]".format(rows, table_name, key_columns(columns)))
+    with Indent(printer):
+
+        order = ', '.join(columns)
+        get_keys = 'select {0} from {1} order by {0};'.format(order, table_name)
+        with throttle.remote(observe=False), connection.cursor(SSCursor) as stream:
+            printer(get_keys, level=DEBUG)
+            stream.execute(get_keys)
+
+            # every `rows`th key (after the first) starts a chunk
+            boundaries = []
+            count = 0
+            for key in stream:
+                if count and count % rows == 0:
+                    boundaries.append(tuple(key))
+                count += 1
+
+        printer("{} keys upstream".format(count))
+
+    starts = [None] + boundaries
+    ends = boundaries + [None]
+    chunks = [ KeyInterval(columns, start, end) for start, end in zip(starts, ends) ]
+    printer("{} chunks".format(len(chunks)))
+    return chunks
+
+# merge neighboring chunks, up to max_chunks at a time
+def coalesce_key_intervals(intervals, max_chunks=None):
+    merged = []
+    count = 0
+    for interval in intervals:
+        if merged and merged[-1].end == interval.start and (max_chunks is None or count < max_chunks):
+            merged[-1].end = interval.end
+            count += 1
+            continue
+        merged.append(KeyInterval(interval.columns, interval.start, interval.end))
+        count = 1
+    return merged
@@ -1,3 +1,5 @@
+from math import ceil
+
 class Interval:
     def __init__(self, start, end):
         self.start = start
@@ -9,8 +11,35 @@ class Interval:
     def __str__(self):
         return self.__repr__()
 
-def make_intervals(start, end, size):
+    # how many ids this interval spans (both ends inclusive)
+    def width(self):
+        return self.end - self.start + 1
+
+# if clip is set, the last interval stops at end - 1 instead of overshooting it
+def make_intervals(start, end, size, clip=False):
     boundaries = list(range(start, end, size))
-    return [ Interval(x, x + size - 1) for x in boundaries ]
+    intervals = [ Interval(x, x + size - 1) for x in boundaries ]
+    if clip and intervals:
+        intervals[-1].end = min(intervals[-1].end, end - 1)
+    return intervals
 
+# cut an interval into at most `parts` contiguous pieces, none of which are narrower than min_size
+# (except maybe the last one, which is clipped to fit)
+def split_interval(interval, parts, min_size=1):
+    size = max(ceil(interval.width() / parts), min_size)
+    return make_intervals(interval.start, interval.end + 1, size, clip=True)
 
+# merge (sorted) intervals that are no more than `gap` ids apart,
+# so long as the merged interval doesn't get wider than max_size
+def coalesce_intervals(intervals, gap=0, max_size=None):
+    merged = []
+    for interval in intervals:
+        if merged:
+            last = merged[-1]
+            close = interval.start - last.end - 1 <= gap
+            fits = max_size is None or interval.end - last.start + 1 <= max_size
+            if close and fits:
+                last.end = max(last.end, interval.end)
+                continue
+        merged.append(Interval(interval.start, interval.end))
+    return merged
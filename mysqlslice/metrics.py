@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# Metrics
+# =======
+
+# Counts things (queries, rows, bytes, intervals...) and times things, per table and per phase.
+# Which table and phase we're in is tracked per thread, so threads that do work on behalf of a step
+# should adopt() the context of the thread that started them.
+# Phases nest, counts go to the innermost one, and each phase's seconds include its children's.
+
+#     with metrics.table('bar'), metrics.phase('scan'):
+#         metrics.count(queries=1, rows=15)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.tables = {}
+
+        # called with ('enter' or 'exit', table, phase) around each phase, i.e. to attach a profiler
+        self.hooks = []
+
+    # start over, i.e. between benchmark runs
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.tables = {}
+
+    def context(self):
+        return (getattr(self.local, 'table', None), getattr(self.local, 'phases', ()))
+
+    @contextmanager
+    def adopt(self, context):
+        outer = self.context()
+        self.local.table, self.local.phases = context
+        try:
+            yield
+        finally:
+            self.local.table, self.local.phases = outer
+
+    def _phase_totals(self, table, phase):
+        phases = self.tables.setdefault(table or '(none)', {})
+        return phases.setdefault(phase or '(none)', {})
+
+    def count(self, **counters):
+        table, phases = self.context()
+        with self.lock:
+            totals = self._phase_totals(table, phases[-1] if phases else None)
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+
+    @contextmanager
+    def table(self, name):
+        with self.adopt((name, ())), self.phase('total'):
+            yield
+
+    @contextmanager
+    def phase(self, name):
+        table, phases = self.context()
+        self.local.phases = phases + (name,)
+        for hook in self.hooks:
+            hook('enter', table, name)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                totals = self._phase_totals(table, name)
+                totals['seconds'] = totals.get('seconds', 0) + elapsed
+                totals['calls'] = totals.get('calls', 0) + 1
+            for hook in self.hooks:
+                hook('exit', table, name)
+            self.local.phases = phases
+
+    def report(self):
+        with self.lock:
+            return { 'started' : time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                     'seconds' : time.time() - self.started,
+                     'tables'  : json.loads(json.dumps(self.tables)) }
+
+    # add up each counter across a table's phases (counts only go to the innermost phase, so nothing is counted twice)
+    def totals(self, table):
+        totals = {}
+        with self.lock:
+            for phase, counters in self.tables.get(table, {}).items():
+                for name, value in counters.items():
+                    if name not in ('seconds', 'calls'):
+                        totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def write(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+# one per process
+metrics = Metrics()
+
+# A hook that runs cProfile over the named phases (or all of them) and saves a .prof file for each
+# table/phase in `directory`.  A thread that's already being profiled isn't profiled again by nested phases.
+# Only one thread is profiled at a time (Python 3.12 allows just one active profiler), so when steps run
+# side by side, phases that start while another thread is being profiled are left out.
+#     metrics.hooks.append(PhaseProfiler('profiles', phases=['scan']))
+class PhaseProfiler:
+    def __init__(self, directory, phases=None):
+        self.directory = directory
+        self.phases = phases
+        self.local = threading.local()
+        self.busy = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, event, table, phase):
+        if self.phases is not None and phase not in self.phases:
+            return
+
+        if event == 'enter' and not getattr(self.local, 'profile', None):
+            if not self.busy.acquire(blocking=False):
+                return
+            self.local.profile = cProfile.Profile()
+            self.local.phase = phase
+            self.local.profile.enable()
+
+        elif event == 'exit' and getattr(self.local, 'phase', None) == phase and self.local.profile:
+            self.local.profile.disable()
+            self.local.profile.dump_stats(os.path.join(self.directory, '{}.{}.prof'.format(table, phase)))
+            self.local.profile = None
+            self.busy.release()
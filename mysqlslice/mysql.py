@@ -1,4 +1,6 @@
+import queue
 import pymysql
+from contextlib import contextmanager
 
 class LocalArgs:
     def __init__(self, user, password, database, socket):
@@ -8,8 +10,9 @@ class LocalArgs:
         self.socket = socket
 
 class RemoteArgs:
-    def __init__(self, host, user, password, database, cipher=None):
+    def __init__(self, host, user, password, database, cipher=None, port=3306):
         self.host = host
+        self.port = port
         self.user = user
         self.password = password
         self.database = database
@@ -34,8 +37,9 @@ class Connection:
         self.database = args.database
 
     # get a cursor for this connection
-    def cursor(self):
-        cursor = self.connection.cursor()
+    # cursorclass overrides the connection's DictCursor, i.e. pymysql.cursors.SSCursor to stream a big result
+    def cursor(self, cursorclass=None):
+        cursor = self.connection.cursor(cursorclass)
 
         # a server I know doesn't like to have the database name in the connection string
         # so I just specify a database on cursor creation
@@ -71,6 +75,7 @@ class RemoteConnection(Connection):
             ssl = None
 
         self.connection = pymysql.connect(host=self.args.host,
+                                          port=self.args.port,
                                           user=self.args.user,
                                           passwd=self.args.password,
                                           ssl=ssl,
@@ -81,3 +86,46 @@ class RemoteConnection(Connection):
         self.connection.db = self.args.database
         return self
 
+
+# a fixed set of connections for sharing among worker threads
+# pymysql connections aren't thread safe, so each one is only lent to one thread at a time.
+# Each connection keeps a single cursor so borrowing doesn't cost an extra 'use' round trip.
+
+#     with ConnectionPool(RemoteConnection, remote_args, 4) as pool:
+#         with pool.cursor() as cursor:
+#             cursor.dostuff()            # blocks until one of the 4 is free
+
+class ConnectionPool:
+    def __init__(self, connection_class, args, size, setup=None):
+        self.connection_class = connection_class
+        self.args = args
+        self.size = size
+
+        # called with each new cursor, for things like session variables
+        self.setup = setup
+
+        self.connections = []
+        self.idle = queue.Queue()
+
+    def __enter__(self):
+        for _ in range(self.size):
+            connection = self.connection_class(self.args).__enter__()
+            self.connections.append(connection)
+
+            cursor = connection.cursor()
+            if self.setup:
+                self.setup(cursor)
+            self.idle.put(cursor)
+        return self
+
+    @contextmanager
+    def cursor(self):
+        cursor = self.idle.get()
+        try:
+            yield cursor
+        finally:
+            self.idle.put(cursor)
+
+    def __exit__(self, type, value, traceback):
+        for connection in self.connections:
+            connection.__exit__(type, value, traceback)
@@ -0,0 +1,53 @@
+from pymysql.cursors import SSCursor
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG
+from mysqlslice.math import Interval
+from mysqlslice.throttle import throttle
+
+# Planning Intervals
+# ==================
+
+# make_intervals slices the id space evenly, starting wherever it's told to.  If the ids start at 10^9,
+# or bulk deletes left big holes, that means lots of empty intervals that still cost a query apiece.
+# Instead, this streams the ids from the remote side so that each interval holds about `rows` rows.
+# Only the remote side is asked, so every target of a fan-out gets the same intervals (see fanout.py).
+# Like make_intervals, they start at 0 (or lower) and end at the remote max id: general_sync calls
+# pull_missing_ids first, which deletes local rows past that.
+def plan_equi_depth(remote_connection, table_name, rows, id_col='id', printer=Prindenter()):
+
+    printer("[Planning intervals of {} rows for {}]".format(rows, table_name))
+    with Indent(printer):
+
+        # one query, read with an unbuffered cursor so the ids arrive as the server finds them
+        # (with InnoDB the primary key is the table, so this reads every row once--but only once,
+        # rather than costing a round trip per interval)
+        # it's one long read, like a dump, so it waits for the load budget but isn't timed against it
+        get_ids = 'select {0} from {1} order by {0};'.format(id_col, table_name)
+        with throttle.remote(observe=False), remote_connection.cursor(SSCursor) as stream:
+            printer(get_ids, level=DEBUG)
+            stream.execute(get_ids)
+
+            # every `rows`th id starts an interval
+            starts = []
+            last = None
+            count = 0
+            for (id,) in stream:
+                if count % rows == 0:
+                    starts.append(id)
+                count += 1
+                last = id
+
+        printer("{} ids upstream".format(count))
+
+    # nothing upstream to walk
+    if not starts:
+        return []
+
+    ends = [ start - 1 for start in starts[1:] ] + [last]
+
+    # local rows below the remote min id get looked at too
+    starts[0] = min(starts[0], 0)
+
+    intervals = [ Interval(start, end) for start, end in zip(starts, ends) ]
+    printer("{} intervals from {} to {}".format(len(intervals), starts[0], last))
+    return intervals
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from mysqlslice.cli import Prindenter, BufferedPrindenter, QUIET
+
+# Runs each step in a pool of worker threads.
+#   run_step(name, printer) does the work, it should open whatever connections it needs
+#   dependencies maps a step to the steps that have to finish before it can start
+# Steps whose dependencies failed are skipped.  If anything failed, the first failure is raised at the end.
+def run_steps(names, run_step, dependencies={}, workers=1, printer=Prindenter()):
+
+    # dependencies on steps that aren't in this run are already satisfied
+    waiting_on = { name : set(dependencies.get(name, [])) & set(names) for name in names }
+
+    done = set()
+    failed = {}
+    pending = list(names)
+
+    def ready():
+        for name in list(pending):
+            if waiting_on[name] & set(failed):
+                pending.remove(name)
+                failed[name] = None
+                printer("[Skipping {}, it depends on {}]".format(name, ', '.join(waiting_on[name] & set(failed))))
+            elif waiting_on[name] <= done:
+                pending.remove(name)
+                yield name
+
+    if workers <= 1:
+        # one at a time, and print as we go
+        while pending:
+            waiting = len(pending)
+            names_ready = list(ready())
+
+            # nothing started or skipped, so what's left is waiting on itself
+            if len(pending) == waiting:
+                raise ValueError("Circular dependency among: {}".format(', '.join(pending)))
+            for name in names_ready:
+                try:
+                    run_step(name, printer)
+                    done.add(name)
+                except Exception as e:
+                    failed[name] = e
+                    printer("[{} failed: {!r}]".format(name, e), level=QUIET)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = {}
+            while pending or in_flight:
+                waiting = len(pending)
+                for name in ready():
+                    step_printer = BufferedPrindenter(verbosity=printer.verbosity)
+                    in_flight[executor.submit(run_step, name, step_printer)] = (name, step_printer)
+
+                if not in_flight:
+                    # nothing started or skipped, so what's left is waiting on itself
+                    if pending and len(pending) == waiting:
+                        raise ValueError("Circular dependency among: {}".format(', '.join(pending)))
+                    continue
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, step_printer = in_flight.pop(future)
+
+                    # steps run side by side, but their output is shown one step at a time
+                    step_printer.replay(printer)
+                    if future.exception():
+                        failed[name] = future.exception()
+                        printer("[{} failed: {!r}]".format(name, future.exception()), level=QUIET)
+                    else:
+                        done.add(name)
+
+    errors = [ e for e in failed.values() if e ]
+    if errors:
+        raise errors[0]
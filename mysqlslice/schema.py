@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-from mysqlslice.cli import parse_pull_args, Prindenter, Indent, mysqldump_schema_nofk_remote, mysqlload_local, show_do_query
+from mysqlslice.cli import parse_pull_args, Prindenter, Indent, INFO, mysqldump_schema_nofk_remote, mysqlload_local, show_do_query
 from mysqlslice.mysql import LocalConnection, LocalArgs, RemoteConnection, RemoteArgs
 
 def pull_schema(cli_args, local_args, remote_connection, printer=Prindenter()):
@@ -28,7 +28,7 @@ def pull_schema(cli_args, local_args, remote_connection, printer=Prindenter()):
         mysqlload_local(cli_args, tmp_file, printer=printer)
 
 def main(args):
-    printer = Prindenter(indent=0)
+    printer = Prindenter(indent=0, verbosity=getattr(args, 'verbosity', INFO))
 
     printer('Pulling schema from {} to localhost'.format(args.remote_host))
 
@@ -36,7 +36,8 @@ def main(args):
     local_args = LocalArgs(args.local_user, args.local_password, args.local_database, args.local_socket)
 
     # set up remote connection
-    remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password, args.remote_database, args.cipher)
+    remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password, args.remote_database, args.cipher,
+                             port=args.remote_port)
     with RemoteConnection(remote_args) as remote_connection, Indent(printer):
         pull_schema(args, local_args, remote_connection, printer=printer)
 
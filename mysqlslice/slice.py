@@ -1,10 +1,19 @@
 #! /usr/bin/env python3
+import copy
 
-from mysqlslice.cli import parse_pull_args, Prindenter, Indent
+from mysqlslice.cli import parse_pull_args, Prindenter, Indent, INFO, DEBUG
 
 from mysqlslice.mysql import LocalConnection, LocalArgs, RemoteConnection, RemoteArgs
 
-from mysqlslice.sync import general_sync, pull_foo, pull_missing_ids
+from mysqlslice.sync import general_sync, pull_subset, pull_missing_ids, keyset_sync
+
+from mysqlslice.subset import Subset, Edge
+
+from mysqlslice.schedule import run_steps
+from mysqlslice.catalog import catalogs, get_catalog
+from mysqlslice.throttle import throttle
+from mysqlslice.fanout import shared
+from mysqlslice.metrics import metrics, PhaseProfiler
 
 
 # Different tables may require different functionality for syncing.
@@ -12,31 +21,74 @@ from mysqlslice.sync import general_sync, pull_foo, pull_missing_ids
 def get_steps(cli_args, local_args, remote_connection, printer=Prindenter()):
 
     return {
-            'foo_tokens' : lambda : pull_foo(cli_args, local_args, remote_connection, printer=printer),
-            # 'foo' gets it's own sync function.
-            # It pulls only a subset of `foo_ref` and then pulls only the subset of `foo_token`that is referenced by `foo_ref`.
-            # It always clobbers the entire target table with the new data.
+            'foo_tokens' : lambda : pull_subset(foo, cli_args, local_args, remote_connection, printer=printer),
+            # 'foo' is synced as a subset (see below)
+            # It pulls only the relevant rows of `foo_ref`, and then only the rows of `foo_tokens` that they reference.
+            # Both tables are compared chunk by chunk, and only chunks that differ get replaced.
+            # If most of the subset changes between runs, replace_subset(foo, ...) is cheaper: it dumps both
+            #   subsets whole, loads them into fresh copies of the tables, and swaps those in with one RENAME TABLE
 
             'foo_ref'    : None,
-            # This table also handled by pull_foo
+            # This table also handled by pull_subset
 
-            'bar' : lambda : general_sync('bar', 15, cli_args, local_args, remote_connection, printer=printer),
+            'bar' : lambda : general_sync('bar', 'auto', cli_args, local_args, remote_connection, printer=printer),
             # 'bar' experiences INSERTs, DELETEs, and UPDATEs, so it needs a full sync
             # gerenal_sync first calls pull_missing_id, so any newly added rows are present in the target.
             #   Then it partitions the table based on id-range and compares MD5 hashes of each partition, and
             #   then it transfers whichever partitions contained changes.
-            # Based on its size, we'll sync it in batches of 15
+            # 'auto' lets it pick the size of those partitions from how long earlier runs spent on each (see tune.py)
             #   too large means we spend less time finding the changes and more time moving data
             #   too small means we spend more time finding the changes and less time moving data
-            #   consider the relative value of network bandwith vs cpu time in your own case
+            #   pass a number instead (i.e. 15) if you'd rather weigh network bandwith vs cpu time yourself
+            # For big tables with few changes, pass fanout=10 (or so) to scan by recursive descent instead:
+            #   wide ranges get hashed first and only the ones that differ get split, down to the partition size
+            # If the remote server is far away, pass remote_workers=4 (or so) to hash several intervals at once
+            #   on both servers, with local_workers to limit the local side separately
+            # Pass engine=BucketEngine() to hash up to 1000 intervals per query (see fingerprint.py)
+            #   this also lifts the group_concat_max_len limit on how wide an interval can be
+            # Pass row_diffs=True to copy only the rows that differ within each differing partition
+            #   so partitions can be wide without moving lots of unchanged rows
+            # Tables with big TEXT/BLOB/JSON columns can pass policy=ColumnPolicy(digest_large=True) (see fingerprint.py)
+            #   to hash those columns on their own, and with row_diffs only send them when they've changed
+            # Pass cache_fingerprints=True to keep local fingerprints between runs (in .mysqlslice/)
+            #   so that only the remote side gets hashed, use --verify-local if you suspect they're stale
+            #   the cache is dropped whenever the partition size changes, so it pays off most with a fixed size
+            # Tables without an integer id column can use keyset_sync('table', 1000, ...) instead,
+            #   it walks the primary key (whatever it is) to find chunks of ~1000 rows to compare
+            # Tables with an indexed updated_at column can use pull_updated_rows('table', ...) instead,
+            #   it pulls whatever changed since the last run, with a general_sync every so often to catch deletes
+            # Hot tables can be followed through the remote binlog with binlog.tail_binlog(['table', ...], ...)
+            #   (needs pip install mysqlslice[binlog], falls back to general_sync if its position was purged)
 
             'baz' : lambda : pull_missing_ids('baz', cli_args, local_args, remote_connection, printer=printer),
             # this table only experiences INSERTs, so we can just sync via max(id)
+            # for big initial pulls, pass workers=4 (or so) to download several batches while earlier ones load
+
+            'qux' : lambda : keyset_sync('qux', 10, cli_args, local_args, remote_connection, printer=printer),
+            # 'qux' has no id column, its primary key is (name, seq)
+            # so it's compared in chunks of 10 rows, found by walking that key on the remote side
+            }
+
+
+# Only these rows of foo_ref matter, and only the foo_tokens they point to.
+# Edges are followed in order, so list parents before their children.
+foo = Subset('foo_ref', "name like 'relevant%'",
+             [ Edge('foo_tokens', 'id', 'foo_ref', 'foo_token_id') ])
+             # foo_tokens.id in (select foo_token_id from the relevant foo_ref rows)
+
+
+# With --jobs, steps run side by side.  List any step that has to wait on other steps here,
+# i.e. a parent table that should be loaded before its children.
+def get_dependencies():
+
+    return {
+            # i.e. 'orders' : ['customers'],
+            # foo_ref and foo_tokens don't need an entry, pull_subset syncs both in one step (parents first)
             }
 
 
 def main(args):
-    printer = Prindenter(indent=0)
+    printer = Prindenter(indent=0, verbosity=getattr(args, 'verbosity', INFO))
 
     printer('Syncing {} to localhost'.format(args.remote_host))
 
@@ -48,26 +100,108 @@ def main(args):
 
     if hasattr(args, 'cipher'):
         remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password,
-                                 args.remote_database, cipher=args.cipher)
+                                 args.remote_database, cipher=args.cipher, port=args.remote_port)
     else:
         remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password,
-                                 args.remote_database)
-
-    printer('connecting with:')
-    printer(remote_args.__dict__)
-    with RemoteConnection(remote_args) as remote_connection, Indent(printer):
-
-        # do the sync-steps for each table in the slice
-        for table_name, sync_func in get_steps(args, local_args, remote_connection, printer).items():
-            printer('[Table: {}]'.format(table_name))
-            with Indent(printer):
-                if sync_func:
-                    sync_func()
+                                 args.remote_database, port=args.remote_port)
+
+    printer('connecting with:', level=DEBUG)
+    printer(remote_args.__dict__, level=DEBUG)
+
+    # with --also-into, each table is synced into several local databases, one after another
+    # they're each compared and loaded separately, but share what's read from the remote server (see fanout.py)
+    targets = [ (args, local_args) ]
+    for database in getattr(args, 'also_into', []):
+        target_args = copy.copy(args)
+        target_args.local_database = database
+        targets.append((target_args, LocalArgs(args.local_user, args.local_password, database, args.local_socket)))
+
+    if len(targets) > 1:
+        shared.watch(remote_args)
+        printer('Fanning out to {}'.format(', '.join(target.database for _, target in targets)))
+
+        # streamed rows can't be shared, dumps can
+        if getattr(args, 'transfer', None) == 'stream':
+            printer('(transferring with dump, not stream, so each range is only read once)')
+            for target_args, _ in targets:
+                target_args.transfer = 'dump'
+
+    # do the sync-steps for each table in the slice
+    # each step gets its own remote connection so that steps can run side by side
+    def run_step(table_name, printer):
+        printer('[Table: {}]'.format(table_name))
+        with Indent(printer), metrics.table(table_name):
+            if get_steps(args, local_args, None, printer)[table_name]:
+                try:
+                    with RemoteConnection(remote_args) as remote_connection:
+                        for target_args, target in targets:
+                            if len(targets) == 1:
+                                get_steps(target_args, target, remote_connection, printer)[table_name]()
+                                continue
+
+                            printer('[Into {}]'.format(target.database))
+                            with Indent(printer), metrics.phase('into ' + target.database):
+                                get_steps(target_args, target, remote_connection, printer)[table_name]()
+                finally:
+                    shared.forget(table_name)
+                printer("")
+            else:
+                with Indent(printer):
+                    printer("skipped explicitly by slice definition")
                     printer("")
-                else:
-                    with Indent(printer):
-                        printer("skipped explicitly by slice definition")
-                        printer("")
+
+    # how many steps run at once
+    jobs = getattr(args, 'jobs', 1)
+
+    if getattr(args, 'profile', None):
+        metrics.hooks.append(PhaseProfiler(args.profile))
+        if jobs > 1:
+            printer('(profiling one step at a time, steps that overlap a profiled one are left out)')
+
+    # stay within the remote server's load budget, if there is one (see throttle.py)
+    throttle.configure(remote_args,
+                       max_threads_running=getattr(args, 'max_threads_running', None),
+                       max_replica_lag=getattr(args, 'max_replica_lag', None),
+                       max_query_seconds=getattr(args, 'max_query_seconds', None),
+                       max_bytes_per_second=getattr(args, 'max_bytes_per_second', None),
+                       max_remote_ops=getattr(args, 'max_remote_ops', None))
+
+    # load metadata for every table on both servers once, up front, rather than per step
+    catalogs.on_disk = getattr(args, 'cache_catalog', False)
+    with RemoteConnection(remote_args) as remote_connection:
+        with remote_connection.cursor() as remote_cursor:
+            remote_catalog = get_catalog(remote_cursor, printer=printer)
+    for _, target in targets:
+        with LocalConnection(target) as local_connection:
+            with local_connection.cursor() as local_cursor:
+                get_catalog(local_cursor, printer=printer)
+
+    # steps whose dependencies are met start in this order
+    # one at a time, that's the order in get_steps, but side by side the big ones should start first
+    # (otherwise the biggest table might be the last one to start, and everything waits on it)
+    def size(table_name):
+        if table_name in remote_catalog.tables:
+            return remote_catalog.estimate(table_name)['bytes'] or 0
+        return 0
+    names = list(get_steps(args, local_args, None, printer))
+    if jobs > 1:
+        names.sort(key=size, reverse=True)
+
+    try:
+        with Indent(printer):
+            run_steps(names,
+                      run_step,
+                      dependencies=get_dependencies(),
+                      workers=jobs,
+                      printer=printer)
+    finally:
+        throttle.close()
+
+        # even (especially) if something went wrong
+        metrics_file = getattr(args, 'metrics_file', None)
+        if metrics_file:
+            metrics.write(metrics_file)
+            printer('Wrote timings and counts to {}'.format(metrics_file))
 
     printer('Done')
 
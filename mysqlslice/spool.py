@@ -0,0 +1,80 @@
+import os
+import json
+import shutil
+import threading
+
+# Batched dumps go one file per batch into <table>.spool/ (<database>.<table>.spool/, given the local database)
+# manifest.json notes which batches made it to disk (and how big they were) and which were loaded,
+# so if the connection gets axed partway through, the next run only has to dump what's missing.
+class Spool:
+    def __init__(self, table_name, database=None):
+        self.table_name = table_name
+
+        # each local database keeps track of its own batches, in case several are synced from one dump
+        self.directory = '.'.join(filter(None, [database, table_name, 'spool']))
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+
+        # batches may be dumped from several threads at once
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.batches = json.load(f)['batches']
+        else:
+            self.batches = {}
+
+    def file_for(self, interval):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, '{}-{}.sql'.format(interval.start, interval.end))
+
+    # was this batch dumped (with this same condition) on a previous attempt?
+    def is_dumped(self, interval, condition):
+        batch = self.batches.get(str(interval))
+        return bool(batch) and batch['condition'] == condition and os.path.exists(batch['file'])
+
+    def dumped(self, interval, condition):
+        file_name = self.file_for(interval)
+        with self.lock:
+            self.batches[str(interval)] = { 'condition' : condition,
+                                            'file'      : file_name,
+                                            'bytes'     : os.path.getsize(file_name),
+                                            'loaded'    : False }
+            self.save()
+
+    def is_loaded(self, interval):
+        batch = self.batches.get(str(interval))
+        return bool(batch) and batch['loaded']
+
+    def loaded(self, interval):
+        with self.lock:
+            self.batches[str(interval)]['loaded'] = True
+            self.save()
+
+    # forget batches from earlier attempts that this one didn't ask for
+    # (they were either loaded already or were for a range that has since moved)
+    def keep_only(self, intervals):
+        wanted = set(str(interval) for interval in intervals)
+        for key in list(self.batches):
+            if key not in wanted:
+                batch = self.batches.pop(key)
+                if os.path.exists(batch['file']):
+                    os.remove(batch['file'])
+        self.save()
+
+    # all of them, or just this batch
+    def bytes(self, interval=None):
+        if interval:
+            return self.batches[str(interval)]['bytes']
+        return sum(batch['bytes'] for batch in self.batches.values())
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump({ 'table' : self.table_name, 'batches' : self.batches }, f, indent=2)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    # everything made it in, start fresh next time
+    def clear(self):
+        self.batches = {}
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
@@ -0,0 +1,25 @@
+import os
+import json
+
+# mysqlslice keeps a few things between runs (fingerprints, checkpoints, ...)
+# they live here, relative to the working directory--just like the .sql files that dumps leave behind
+state_dir = '.mysqlslice'
+
+def state_path(*names):
+    os.makedirs(state_dir, exist_ok=True)
+    return os.path.join(state_dir, '.'.join(names) + '.json')
+
+# names are joined to make the file name, i.e. load_state('fingerprints', 'things_downstream', 'bar')
+def load_state(*names, default=None):
+    path = state_path(*names)
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+# write to a temp file first so that a crash can't leave half a file behind
+def save_state(data, *names):
+    path = state_path(*names)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,120 @@
+from pymysql.cursors import SSCursor
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG
+from mysqlslice.math import Interval
+from mysqlslice.fingerprint import range_condition
+from mysqlslice.throttle import throttle
+
+# Subsets
+# =======
+
+# Some tables only need the rows that matter to us: the rows of a root table that match a filter,
+# plus whatever rows of other tables they point to (or that point to them), and so on.
+#
+#     foo = Subset('foo_ref', "name like 'relevant%'",
+#                  [ Edge('foo_tokens', 'id', 'foo_ref', 'foo_token_id') ])
+#
+# Each table's part of the subset is described by a condition that the remote server evaluates
+# (with subqueries for the edges), so ids never pass through python or the command line:
+#
+#     foo_ref:     name like 'relevant%'
+#     foo_tokens:  id in (select foo_token_id from foo_ref where name like 'relevant%')
+
+# the rows of `table` whose `column` matches `from_column` of the rows of `from_table` in the subset
+# (i.e. a foreign key from from_table to table, or the other way around)
+class Edge:
+    def __init__(self, table, column, from_table, from_column):
+        self.table = table
+        self.column = column
+        self.from_table = from_table
+        self.from_column = from_column
+
+class Subset:
+    def __init__(self, root, where, edges=[]):
+        self.root = root
+        self.where = where
+        self.edges = edges
+
+    # tables in the order they should be synced, parents first
+    def tables(self):
+        tables = [self.root]
+        for edge in self.edges:
+            if edge.table not in tables:
+                tables.append(edge.table)
+        return tables
+
+    # the remote rows of table_name that are in the subset, as sql
+    # a table reached by more than one edge gets the rows from each of them
+    def condition(self, table_name, seen=()):
+        if table_name in seen:
+            raise ValueError("The subset edges loop back to {}".format(table_name))
+
+        conditions = []
+        if table_name == self.root:
+            conditions.append(self.where)
+
+        for edge in self.edges:
+            if edge.table == table_name:
+                conditions.append('{} in (select {} from {} where {})'.format(
+                                      edge.column, edge.from_column, edge.from_table,
+                                      self.condition(edge.from_table, seen + (table_name,))))
+
+        if not conditions:
+            raise ValueError("{} isn't reached by the subset".format(table_name))
+
+        return ' or '.join('({})'.format(condition) for condition in conditions)
+
+# an id range, narrowed to the subset on the remote side
+class SubsetInterval(Interval):
+    def __init__(self, start, end, subset_condition, id_col='id'):
+        super().__init__(start, end)
+        self.subset_condition = subset_condition
+        self.id_col = id_col
+
+    def condition(self):
+        return '{} AND ({})'.format(range_condition(Interval(self.start, self.end), id_col=self.id_col),
+                                    self.subset_condition)
+
+# Stream the remote subset's ids (in order, without holding them all) and cut them into chunks of
+# about `rows` apiece, from 0 (or lower) to the last id in the subset.  Only the remote side is asked, so
+# every target of a fan-out gets the same chunks (see fanout.py).  Local rows past the last chunk have
+# left the subset, pull_subset looks at those separately.
+def plan_subset_chunks(remote_connection, table_name, condition, rows, id_col='id', printer=Prindenter()):
+
+    printer("[Planning chunks of {} rows for the {} subset]".format(rows, table_name))
+    with Indent(printer):
+
+        # an unbuffered cursor, so the ids arrive as the server finds them
+        get_ids = 'select {0} from {1} where {2} order by {0};'.format(id_col, table_name, condition)
+        with throttle.remote(observe=False), remote_connection.cursor(SSCursor) as stream:
+            printer(get_ids, level=DEBUG)
+            stream.execute(get_ids)
+
+            ends = []
+            first = None
+            last = None
+            count = 0
+            for (id,) in stream:
+                if first is None:
+                    first = id
+                count += 1
+                if count % rows == 0:
+                    ends.append(id)
+                last = id
+
+        printer("{} ids upstream".format(count))
+
+    if first is None:
+        return []
+
+    start = min(first, 0)
+    if not ends or ends[-1] < last:
+        ends.append(last)
+
+    chunks = []
+    for end in ends:
+        chunks.append(Interval(start, end))
+        start = end + 1
+
+    printer("{} chunks".format(len(chunks)))
+    return chunks
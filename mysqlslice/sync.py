@@ -1,143 +1,197 @@
-from mysqlslice.math import make_intervals
-from collections import namedtuple
-from copy import deepcopy
-from math import floor
-
-from mysqlslice.cli import Prindenter, Indent, mysqldump_data_remote_batches, mysqldump_data_remote, mysqlload_local, show_do_query
-from mysqlslice.mysql import LocalConnection, LocalArgs, RemoteConnection, RemoteArgs
+from mysqlslice.math import Interval, make_intervals, split_interval, coalesce_intervals
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import ExitStack
+import time
+
+from mysqlslice.cli import Prindenter, BufferedPrindenter, Indent, DEBUG, mysqldump_data_remote, \
+                          mysqlload_local, pull_batches, plan_batches, show_do_query
+from mysqlslice.mysql import LocalConnection, RemoteConnection, ConnectionPool
+from mysqlslice.state import load_state, save_state
+from mysqlslice.metrics import metrics
+from mysqlslice.throttle import throttle
+from mysqlslice.fanout import shared
+from mysqlslice.plan import plan_equi_depth
+from mysqlslice.tune import IntervalTuner
+from mysqlslice.catalog import get_catalog
+from mysqlslice.keyset import get_primary_key, plan_key_chunks, coalesce_key_intervals
+from mysqlslice.subset import SubsetInterval, plan_subset_chunks
+from mysqlslice.transfer import RowColumns, transfer_row_diffs, get_transfer, DumpTransfer
+from mysqlslice.verify import is_equal, summaries_match, checksums_match, verify, get_mode, sample, sample_intervals
+from mysqlslice.fingerprint import examine_columns, md5_row_range, get_max_md5_rows, GroupConcatEngine, \
+                                   FingerprintCache
 
 # On a server I know, remote connections get axed if they take too long
 # pull this many rows per connection to fly under the radar
 batch_rows = 100000
 
-# this logic assumes that only certain rows in foo_ref and foo_tokens actually need to be synced
-def pull_foo(cli_args, local_args, remote_connection, printer=Prindenter()):
-
-    # grab only the foo token indices that are relevant
-    with remote_connection.cursor() as remote_cursor:
+# for tables where only a subset of the rows are needed (see subset.py)
+# each table's subset is streamed from the remote side in chunks of about chunk_rows ids, and only the
+# chunks whose fingerprints differ are transferred, so rows that haven't changed stay put
+# policies maps table names to ColumnPolicies (see fingerprint.py)
+@metrics.phase('pull_subset')
+def pull_subset(subset, cli_args, local_args, remote_connection, chunk_rows=10000, policies={},
+                printer=Prindenter()):
 
-        get_ids = '''select id, foo_token_id from foo_ref where name like 'relevant%';'''
+    for table_name in subset.tables():
+        condition = subset.condition(table_name)
 
-        result = show_do_query(remote_cursor, get_ids, printer=printer)
-        foo_token_ids =  ', '.join([str(x['foo_token_id']) for x in result])
-        foo_ref_ids =  ', '.join([str(x['id']) for x in result])
-
-    # dump just those rows
-    mysqldump_data_remote(cli_args, 'foo_ref', 'id in ({});'.format(foo_ref_ids), printer=printer)
-    mysqldump_data_remote(cli_args, 'foo_tokens', 'id in ({});'.format(foo_token_ids), printer=printer)
+        printer("[Scanning for diffs in the {} subset]".format(table_name))
+        with Indent(printer), metrics.phase('scan'):
+            with LocalConnection(local_args) as local_connection:
+                with local_connection.cursor() as local_cursor:
+                    with remote_connection.cursor() as remote_cursor:
+
+                        remote_max = get_max_md5_rows(remote_cursor, printer=printer)
+                        local_max = get_max_md5_rows(local_cursor, printer=printer)
+                        rows = min(remote_max, local_max, chunk_rows)
+
+                        # the same chunks for every target, if fanning out (see fanout.py)
+                        chunks = shared.plan('chunks of ' + table_name,
+                                             lambda : plan_subset_chunks(remote_connection, table_name, condition,
+                                                                         rows, printer=printer))
+
+                        # local rows past the end of the remote subset have left it, so they get a chunk of their own
+                        local_max_id = get_max_id(local_cursor, table_name, printer=printer)
+                        if local_max_id is not None and (not chunks or local_max_id > chunks[-1].end):
+                            chunks = chunks + [Interval(chunks[-1].end + 1 if chunks else min(local_max_id, 0),
+                                                        local_max_id)]
+
+                        printer("[Examining table formats on either side]")
+                        with Indent(printer):
+                            policy = policies.get(table_name)
+                            local_columns = examine_columns(local_cursor, table_name, policy=policy, printer=printer)
+                            remote_columns = examine_columns(remote_cursor, table_name, policy=policy,
+                                                             printer=printer)
+
+                        # the local table should hold exactly the subset, so only the remote side is narrowed
+                        diff_chunks = []
+                        for chunk in chunks:
+                            remote_chunk = SubsetInterval(chunk.start, chunk.end, condition)
+                            local_fingerprint = md5_row_range(local_cursor, table_name, local_columns, chunk,
+                                                              printer=printer)
+                            with throttle.remote():
+                                remote_fingerprint = md5_row_range(remote_cursor, table_name, remote_columns,
+                                                                   remote_chunk, printer=printer)
+                            metrics.count(intervals_scanned=1)
+                            if local_fingerprint == remote_fingerprint:
+                                metrics.count(intervals_matched=1)
+                            else:
+                                diff_chunks.append(remote_chunk)
+
+        printer("[Transferring {} diffs in the {} subset]".format(len(diff_chunks), table_name))
+        with Indent(printer), metrics.phase('transfer'), \
+             get_transfer(cli_args, local_args, remote_connection) as transfer:
+            metrics.count(intervals_transferred=len(diff_chunks), transfer_ranges=len(diff_chunks))
+
+            for chunk in diff_chunks:
+
+                # clear old rows from local, including any that have left the subset
+                everything = 'id >= {} and id <= {}'.format(chunk.start, chunk.end)
+                transfer.replace_range(table_name, chunk.condition(), delete_condition=everything, printer=printer)
+
+    printer("{} are up to date where it matters".format(' and '.join(subset.tables())))
+
+# for subsets that change too much to be worth diffing: dump each table's whole subset and swap the new
+# copies in all at once (see replace_via_shadow), so readers never see partly loaded tables
+@metrics.phase('replace_subset')
+def replace_subset(subset, cli_args, local_args, remote_connection, defer_indexes=True, printer=Prindenter()):
+
+    for table_name in subset.tables():
+        mysqldump_data_remote(cli_args, table_name, subset.condition(table_name), printer=printer)
+
+    replace_via_shadow(subset.tables(), cli_args, local_args, defer_indexes=defer_indexes, printer=printer)
+
+    printer("{} are up to date where it matters".format(' and '.join(subset.tables())))
+
+# every index but the primary key, as clauses for ALTER TABLE ... ADD
+def get_secondary_indexes(cursor, table_name, printer=Prindenter()):
+
+    indexes = {}
+    for row in get_catalog(cursor, table_name, printer=printer).indexes(table_name):
+        if row['INDEX_NAME'] != 'PRIMARY':
+            indexes.setdefault(row['INDEX_NAME'], []).append(row)
+
+    clauses = {}
+    for name, rows in indexes.items():
+
+        # functional indexes have no column name, leave those alone
+        if any(row['COLUMN_NAME'] is None for row in rows):
+            continue
+
+        columns = []
+        for row in sorted(rows, key=lambda row: row['SEQ_IN_INDEX']):
+            if row['SUB_PART']:
+                columns.append('`{}`({})'.format(row['COLUMN_NAME'], row['SUB_PART']))
+            else:
+                columns.append('`{}`'.format(row['COLUMN_NAME']))
 
-    # clear old rows
-    with LocalConnection(local_args) as local_connection:
-        with local_connection.cursor() as cursor:
+        if rows[0]['INDEX_TYPE'] in ['FULLTEXT', 'SPATIAL']:
+            kind = rows[0]['INDEX_TYPE'] + ' INDEX'
+        elif int(rows[0]['NON_UNIQUE']) == 0:
+            kind = 'UNIQUE INDEX'
+        else:
+            kind = 'INDEX'
 
-            show_do_query(cursor, 'truncate foo_ref;', printer=printer)
-            show_do_query(cursor, 'truncate foo_tokens;', printer=printer)
+        clauses[name] = '{} `{}` ({})'.format(kind, name, ', '.join(columns))
 
-    # load new rows
-    mysqlload_local(cli_args, 'foo_ref', printer=printer)
-    mysqlload_local(cli_args, 'foo_tokens', printer=printer)
+    return clauses
 
-    printer("foo_tokens and foo_ref are up to date where it matters")
+# Truncating and reloading leaves readers looking at empty or partial tables for the whole load.
+# Instead, this loads each table's dump (<table>.sql, from mysqldump_data_remote) into <table>__new
+# and then swaps them all in with a single RENAME TABLE.
+# With defer_indexes, the shadow tables are loaded without their secondary indexes, which are rebuilt afterwards.
+@metrics.phase('replace_via_shadow')
+def replace_via_shadow(table_names, cli_args, local_args, defer_indexes=False, printer=Prindenter()):
 
-# not all columns can be concatenated (i.e. NULL)
-# this gets the list of columns and figures out how to make them concatenatabale
-def examine_columns(cursor, table_name, printer=Prindenter()):
+    shadows = { table_name : table_name + '__new' for table_name in table_names }
+    deferred = {}
 
-    printer("[Examining Columns on {}.{}]".format(cursor.connection.db, table_name))
+    printer("[Creating shadow tables for {}]".format(', '.join(table_names)))
     with Indent(printer):
-        result = show_do_query(cursor,
-                """
-                SELECT COLUMN_NAME, IS_NULLABLE, COLUMN_TYPE, COLLATION_NAME
-                FROM information_schema.columns
-                WHERE table_schema='{}'
-                AND table_name='{}';
-                """.format(cursor.connection.db, table_name),
-                printer=printer)
-
-        column_conversions= []
-
-        for column in result:
-
-            # make the column representation concatenate-friendly
-            converted = column['COLUMN_NAME']
-
-            if column['IS_NULLABLE'] == 'YES':
-                converted = "IFNULL({}, 'NULL')".format(converted)
-
-            if column['COLLATION_NAME'] and column['COLLATION_NAME'] not in ['NULL', 'utf8_general_ci']:
-                converted = "BINARY {}".format(converted)
-
-            # your data may deviate in new and exciting ways
-            # handle them here ...
-
-            with Indent(printer):
-                printer(converted)
-            column_conversions.append(converted)
-
-        return column_conversions
+        with LocalConnection(local_args) as local_connection:
+            with local_connection.cursor() as cursor:
+                for table_name, shadow in shadows.items():
 
+                    # leftovers from an interrupted run
+                    show_do_query(cursor, 'drop table if exists {};'.format(shadow), printer=printer)
+                    show_do_query(cursor, 'create table {} like {};'.format(shadow, table_name), printer=printer)
 
-def md5_row_range(cursor, table_name, column_conversions, interval, id_col='id', printer=Prindenter()):
+                    # the shadow was made LIKE the table, so the catalog already knows its indexes
+                    if defer_indexes:
+                        deferred[shadow] = get_secondary_indexes(cursor, table_name, printer=printer)
+                        if deferred[shadow]:
+                            drops = ', '.join('DROP INDEX `{}`'.format(name) for name in deferred[shadow])
+                            show_do_query(cursor, 'alter table {} {};'.format(shadow, drops), printer=printer)
 
-    printer("[Fingerprinting " + cursor.connection.db
-             + ".{table_name} across rows where {id_col} in {interval}]".format(**vars()))
+    printer("[Loading shadow tables]")
     with Indent(printer):
+        for table_name, shadow in shadows.items():
+            mysqlload_local(cli_args, table_name, into_table=shadow, printer=printer)
 
-        # concat-friendly conversions for the target table
-        converted_columns_str = ",".join(column_conversions)
-
-        # hash the row-range
-        start = interval.start
-        end = interval.end
-
-        condition = "{id_col} >= {start} AND {id_col} < {end}".format(**vars())
-
-        result = show_do_query(cursor,
-                """
-                SELECT MD5(GROUP_CONCAT(row_fingerprints)) AS range_fingerprint from
-                    (SELECT MD5(CONCAT({})) as row_fingerprints
-                    FROM {}
-                    WHERE {}
-                    ORDER BY {}) as r;
-                """.format(converted_columns_str,
-                           table_name,
-                           condition,
-                           id_col),
-                printer=printer)
-
-        return result[0]['range_fingerprint']
-
-# row sync relies on group_concat, which silently truncates the output once it reaches
-# group_concat_max_len bytes long.
-# Interrogate the target server to see how many rows we can get away with.
-def get_max_md5_rows(cursor, try_set=1000000 * 33, printer=Prindenter()):
-    # 32 bytes for the md5 plus 1 for the comma times a million rows
-
-    # limiting it here because I'd prefer too many small queries over a few monsters
-    # that ties up the server with no gaps.  This may be unnecessarily cautious, go bigger at your own risk.
-
-    # hell, this is all at your own risk
-
-    printer("[How many rows is {} willing to hash at a time?]".format(cursor.connection.host))
+    printer("[Swapping shadow tables in]")
     with Indent(printer):
+        with LocalConnection(local_args) as local_connection:
+            with local_connection.cursor() as cursor:
 
-        # try to ask for enough space for 1 million rows at a time
-        printer("Asking for lots lof space...")
-        result = show_do_query(cursor, "set session group_concat_max_len = {};".format(try_set), printer=printer)
+                for shadow, clauses in deferred.items():
+                    if clauses:
+                        adds = ', '.join('ADD ' + clause for clause in clauses.values())
+                        show_do_query(cursor, 'alter table {} {};'.format(shadow, adds), printer=printer)
 
-        # but accept what we're given
-        printer("Taking what we can get...")
-        result = show_do_query(cursor, "show variables where Variable_name = 'group_concat_max_len';" , printer=printer)
-        max_group_concat_bytes = int(result[0]['Value'])
+                # leftovers from a run that was interrupted after the swap, the rename can't replace them
+                for table_name in table_names:
+                    show_do_query(cursor, 'drop table if exists {}__old;'.format(table_name), printer=printer)
 
-        # and see how many rows that is
-        printer("How many of these will fit?")
-        result = show_do_query(cursor, "select length(concat(md5('foo'),',')) as md5_bytes;" , printer=printer);
-        md5_bytes = int(result[0]['md5_bytes'])
+                # all at once, so readers see either the old tables or the new ones
+                renames = []
+                for table_name, shadow in shadows.items():
+                    renames.append('{} to {}__old'.format(table_name, table_name))
+                    renames.append('{} to {}'.format(shadow, table_name))
+                show_do_query(cursor, 'rename table {};'.format(', '.join(renames)), printer=printer)
 
-    rows = floor(max_group_concat_bytes / md5_bytes)
-    printer("{} rows".format(rows))
-    return rows
+                for table_name in table_names:
+                    show_do_query(cursor, 'drop table {}__old;'.format(table_name), printer=printer)
 
 def get_max_id(cursor, table_name, id_col='id', printer=Prindenter()):
 
@@ -148,67 +202,175 @@ def get_max_id(cursor, table_name, id_col='id', printer=Prindenter()):
     return result[0][target]
 
 
-# recursive descent would be more optimal
-# TODO: measure and see if it's worth the extra complexity (beware of max_group_concat_length)
-
-# for now just walk the ranges and transfer any with diffs
-def find_diff_intervals(remote_cursor, local_cursor, table_name, intervals, id_col='id', printer=Prindenter()):
+# note which intervals in a batch have differing fingerprints (and tell the cache, if there is one)
+def compare_fingerprints(batch, local_fingerprints, remote_fingerprints, has_diffs, cache=None,
+                         printer=Prindenter()):
+    metrics.count(intervals_scanned=len(batch))
+    for interval, local_fingerprint, remote_fingerprint in zip(batch, local_fingerprints, remote_fingerprints):
+        if local_fingerprint == remote_fingerprint:
+            metrics.count(intervals_matched=1)
+            printer("{} NO SYNC NEEDED\n".format(interval), level=DEBUG)
+            if cache:
+                cache.matched(interval, remote_fingerprint)
+        else:
+            printer("{} NEEDS SYNC\n".format(interval))
+            has_diffs.append(interval)
+            if cache:
+                cache.differs(interval, remote_fingerprint)
+
+def describe_batch(batch):
+    if len(batch) == 1:
+        return str(batch[0])
+    return "{}..{} ({} intervals)".format(batch[0].start, batch[-1].end, len(batch))
+
+# walk the ranges and return any with diffs
+# pass columns=(local_columns, remote_columns) if you've already examined them
+# the engine decides how many intervals get hashed per query (see fingerprint.py)
+# if there's a FingerprintCache, local fingerprints come from there when it has them
+def find_diff_intervals(remote_cursor, local_cursor, table_name, intervals, id_col='id', columns=None,
+                        engine=GroupConcatEngine(), cache=None, printer=Prindenter()):
 
     has_diffs = []
 
-    printer("Examining table formats on either side]")
-    with Indent(printer):
-        local_columns = examine_columns(local_cursor, table_name, printer=printer)
-        remote_columns = examine_columns(remote_cursor, table_name, printer=printer)
+    if columns:
+        local_columns, remote_columns = columns
+    else:
+        printer("Examining table formats on either side]")
+        with Indent(printer):
+            local_columns = examine_columns(local_cursor, table_name, printer=printer)
+            remote_columns = examine_columns(remote_cursor, table_name, printer=printer)
 
     printer("[Scanning intervals for changes]")
     with Indent(printer):
-        for interval in intervals:
+        for batch in engine.batches(intervals):
 
-            printer("[Scanning {}]".format(interval))
+            printer(lambda : "[Scanning {}]".format(describe_batch(batch)), level=DEBUG)
             with Indent(printer):
-                local_fingerprint = md5_row_range(local_cursor, table_name, local_columns, interval,
-                                                  id_col=id_col, printer=printer)
+                local_fingerprints = cache.lookup(batch) if cache else None
+                if local_fingerprints is None:
+                    local_fingerprints = engine.fingerprint(local_cursor, table_name, local_columns, batch,
+                                                            id_col=id_col, printer=printer)
+                else:
+                    printer("(local fingerprints from cache)", level=DEBUG)
 
-                remote_fingerprint = md5_row_range(remote_cursor, table_name, remote_columns, interval,
-                                                   id_col=id_col, printer=printer)
+                with throttle.remote():
+                    remote_fingerprints = engine.fingerprint(remote_cursor, table_name, remote_columns, batch,
+                                                             id_col=id_col, printer=printer)
 
-            if local_fingerprint == remote_fingerprint:
-                printer("{} NO SYNC NEEDED\n".format(interval))
-            else:
-                printer("{} NEEDS SYNC\n".format(interval))
-                has_diffs.append(interval)
+            compare_fingerprints(batch, local_fingerprints, remote_fingerprints, has_diffs, cache=cache,
+                                 printer=printer)
 
     return has_diffs
 
-def is_equal(remote_cursor, local_cursor, table_name, printer=Prindenter()):
-    printer("[Checking table equality for {}]".format(table_name))
+# like find_diff_intervals, but both servers hash at the same time, and each keeps as many batches
+# in flight as its pool has connections.  Results are still reported in order.
+def find_diff_intervals_concurrent(remote_pool, local_pool, table_name, intervals, id_col='id', columns=None,
+                                   engine=GroupConcatEngine(), cache=None, printer=Prindenter()):
 
-    with Indent(printer):
-        get_checksum = 'checksum table {};'.format(table_name)
+    has_diffs = []
 
-        result = show_do_query(remote_cursor, get_checksum, printer=printer)
-        remote_checksum = result[0]['Checksum']
+    if columns:
+        local_columns, remote_columns = columns
+    else:
+        printer("[Examining table formats on either side]")
+        with Indent(printer):
+            with local_pool.cursor() as local_cursor:
+                local_columns = examine_columns(local_cursor, table_name, printer=printer)
+            with remote_pool.cursor() as remote_cursor:
+                remote_columns = examine_columns(remote_cursor, table_name, printer=printer)
+
+    # runs in a worker thread, so it gets its own printer (and borrows this thread's metrics context)
+    context = metrics.context()
+    def fingerprint(pool, columns, batch):
+        buffer = BufferedPrindenter(verbosity=printer.verbosity)
+        with pool.cursor() as cursor, metrics.adopt(context):
+            result = engine.fingerprint(cursor, table_name, columns, batch, id_col=id_col, printer=buffer)
+        return result, buffer
+
+    # the remote server's load budget is shared by every thread (see throttle.py)
+    def fingerprint_remote(batch):
+        with metrics.adopt(context), throttle.remote():
+            return fingerprint(remote_pool, remote_columns, batch)
+
+    # skip the local server if the cache already knows the answer
+    def fingerprint_local(batch):
+        cached = cache.lookup(batch) if cache else None
+        if cached is None:
+            return local_executor.submit(fingerprint, local_pool, local_columns, batch)
+
+        buffer = BufferedPrindenter(verbosity=printer.verbosity)
+        buffer("(local fingerprints from cache)", level=DEBUG)
+        future = Future()
+        future.set_result((cached, buffer))
+        return future
+
+    def compare(batch, local_future, remote_future):
+        printer(lambda : "[Scanning {}]".format(describe_batch(batch)), level=DEBUG)
+        local_fingerprints, local_output = local_future.result()
+        remote_fingerprints, remote_output = remote_future.result()
+        with Indent(printer):
+            local_output.replay(printer)
+            remote_output.replay(printer)
 
-        result = show_do_query(local_cursor, get_checksum, printer=printer)
-        local_checksum = result[0]['Checksum']
+        compare_fingerprints(batch, local_fingerprints, remote_fingerprints, has_diffs, cache=cache,
+                             printer=printer)
 
-        if remote_checksum != local_checksum:
-            printer("WARNING: {} differs, even after sync!".format(table_name))
-            return False
-        else:
-            return True
-            printer("{} is identical on either side".format(table_name))
+    # don't queue up more work than the pools can chew on, there may be millions of intervals
+    window = 2 * max(local_pool.size, remote_pool.size)
 
-def warn_if_not_equal(remote_cursor, local_cursor, table_name, printer=Prindenter()):
-    if is_equal(remote_cursor, local_cursor, table_name, printer):
-        printer("{} is identical on either side".format(table_name))
-    else:
-        printer("WARNING: {} differs, even after sync!".format(table_name))
+    printer("[Scanning intervals for changes, {} local and {} remote at a time]".format(local_pool.size,
+                                                                                        remote_pool.size))
+    with Indent(printer), \
+         ThreadPoolExecutor(max_workers=local_pool.size) as local_executor, \
+         ThreadPoolExecutor(max_workers=remote_pool.size) as remote_executor:
+
+        in_flight = deque()
+        for batch in engine.batches(intervals):
+            in_flight.append((batch,
+                              fingerprint_local(batch),
+                              remote_executor.submit(fingerprint_remote, batch)))
+
+            if len(in_flight) >= window:
+                compare(*in_flight.popleft())
+
+        while in_flight:
+            compare(*in_flight.popleft())
+
+    return has_diffs
+
+# recursive descent: hash wide ranges first and only split the ones that differ
+# keeps splitting (fanout pieces at a time) until the differing intervals are leaf_size wide
+# `scan` takes a list of intervals and returns the ones that differ (i.e. find_diff_intervals)
+# callers should make sure that none of the starting intervals are wider than the engine's max_rows allows
+def find_diff_intervals_recursive(scan, intervals, leaf_size, fanout=10, printer=Prindenter()):
+
+    has_diffs = []
+
+    # one level at a time, so each level is a single pass over the ranges that still matter
+    depth = 0
+    while intervals:
+
+        printer("[Descending to depth {}, {} intervals]".format(depth, len(intervals)))
+        with Indent(printer):
+            differing = scan(intervals)
+
+        intervals = []
+        for interval in differing:
+            if interval.width() <= leaf_size:
+                has_diffs.append(interval)
+            else:
+                intervals.extend(split_interval(interval, fanout, min_size=leaf_size))
+        depth += 1
+
+    return sorted(has_diffs, key=lambda interval: interval.start)
 
 # this works for tables that only experience INSERTs, it just checks on max(id)
 # and syncs the deficit
-def pull_missing_ids(table_name, cli_args, local_args, remote_connection, printer=Prindenter()):
+# new rows are pulled in batches, `workers` of them downloading at once while earlier ones are loaded
+# verify_mode overrides --verify (see verify.py), only 'full' goes beyond comparing row counts and max ids
+@metrics.phase('pull_missing_ids')
+def pull_missing_ids(table_name, cli_args, local_args, remote_connection, workers=1, verify_mode=None,
+                     printer=Prindenter()):
 
     target = 'max(id)';
     get_max_id = 'select {} from {};'.format(target, table_name)
@@ -217,13 +379,13 @@ def pull_missing_ids(table_name, cli_args, local_args, remote_connection, printe
     # then mysqlload_local (below) can't make its own separate connection
     with LocalConnection(local_args) as local_connection:
         with local_connection.cursor() as cursor:
-            printer("Finding max(id) for {}.{}".format(table_name, cursor.connection.db))
+            printer("Finding max(id) for {}.{}".format(table_name, cursor.connection.db), level=DEBUG)
             with Indent(printer):
                 result = show_do_query(cursor, get_max_id, printer=printer)
                 begin = result[0][target] or 0
 
     with remote_connection.cursor() as cursor:
-        printer("Finding max(id) for {}.{}".format(table_name, cursor.connection.db))
+        printer("Finding max(id) for {}.{}".format(table_name, cursor.connection.db), level=DEBUG)
         with Indent(printer):
             result = show_do_query(cursor, get_max_id, printer=printer)
             end = result[0][target] or 0
@@ -242,92 +404,332 @@ def pull_missing_ids(table_name, cli_args, local_args, remote_connection, printe
     else:
         printer("Upstream db has more rows, pulling them.")
 
-        # dump to a file
-        if begin == None:
-            # if the target table is empty, dump everything
-            mysqldump_data_remote_batches(cli_args,
-                                          table_name,
-                                          batch_rows,
-                                          end,
-                                          min_id=begin,
-                                          printer=printer)
-        else:
-            # otherwise, dump just the rows that aren't in the target
-            mysqldump_data_remote_batches(cli_args,
-                                          table_name,
-                                          batch_rows,    # batch size
-                                          end,           # max id
-                                          min_id=begin,
-                                          condition='id > {}'.format(begin),
-                                          printer=printer)
-
-        # load from a file
-        mysqlload_local(cli_args, table_name, printer=printer)
+        with get_transfer(cli_args, local_args, remote_connection) as transfer:
+
+            # dump to files and load them, just the rows that aren't in the target
+            # if an earlier attempt was interrupted, whatever it spooled gets reused
+            if isinstance(transfer, DumpTransfer):
+                pull_batches(cli_args,
+                             table_name,
+                             batch_rows,    # batch size
+                             end,           # max id
+                             min_id=begin + 1,
+                             workers=workers,
+                             printer=printer)
+
+            # or stream them straight in, a batch at a time
+            else:
+                for interval in plan_batches(batch_rows, end, min_id=begin + 1):
+                    condition = 'id >= {} and id <= {}'.format(interval.start, interval.end)
+                    transfer.copy(table_name, condition, printer=printer)
 
     with LocalConnection(local_args) as local_connection:
         with local_connection.cursor() as local_cursor:
             with remote_connection.cursor() as remote_cursor:
-                warn_if_not_equal(remote_cursor, local_cursor, table_name, printer=printer)
+                verify(remote_cursor, local_cursor, table_name, get_mode(cli_args, verify_mode), printer=printer)
 
     # return max id
     return end
 
 # used for tables that don't have a more specific strategy
-def general_sync(table_name, interval_size, cli_args, local_args, remote_connection, printer=Prindenter()):
+# if fanout is set, scan via recursive descent: start with intervals as large as the servers will hash
+# and split the ones that differ into `fanout` pieces until they're interval_size wide
+# if local_workers or remote_workers is set, hash both sides concurrently with that many connections per server
+# engine=BucketEngine() hashes many intervals per query, and isn't limited by group_concat_max_len
+# if cache_fingerprints is set, local fingerprints are kept between runs so usually only the remote side is hashed
+#   (verify_local, or --verify-local, hashes the local side anyway)
+# differing intervals within transfer_gap ids of each other are transferred together,
+#   up to transfer_max ids at a time (the rows in the gaps come along for the ride)
+# if equi_depth is set, intervals hold interval_size rows apiece, rather than spanning interval_size ids
+#   (good for sparse or skewed ids, see plan.py--but the boundaries move as rows come and go,
+#   so cached fingerprints won't get reused as often)
+# if interval_size is 'auto', it's picked from the costs measured on earlier runs (see tune.py)
+# if row_diffs is set, differing ranges are compared row by row and only the rows that differ are copied
+#   (see transfer.py--good for wide intervals with few changes in them)
+# policy is a ColumnPolicy, for leaving out or digesting some columns (see fingerprint.py)
+# verify_mode overrides --verify (see verify.py)
+@metrics.phase('general_sync')
+def general_sync(table_name, interval_size, cli_args, local_args, remote_connection, fanout=None,
+                 local_workers=None, remote_workers=None, engine=GroupConcatEngine(),
+                 cache_fingerprints=False, verify_local=False, transfer_gap=0, transfer_max=batch_rows,
+                 equi_depth=False, row_diffs=False, policy=None, verify_mode=None, printer=Prindenter()):
+
+    verify_mode = get_mode(cli_args, verify_mode)
+
 
     # Check to see if work needs to be done
     with LocalConnection(local_args) as local_connection:
         with local_connection.cursor() as local_cursor:
             with remote_connection.cursor() as remote_cursor:
 
-                if is_equal(remote_cursor, local_cursor, table_name, printer):
+                # counts and max ids first, the checksum only if they match
+                counts_match = summaries_match(remote_cursor, local_cursor, table_name, printer=printer)
+                if counts_match and checksums_match(remote_cursor, local_cursor, table_name, printer=printer):
                     printer("{} is identical on either side".format(table_name))
                     return
 
+                # pull_missing_ids is about to change rows past here
+                if cache_fingerprints:
+                    local_max_id = get_max_id(local_cursor, table_name, printer=printer) or 0
+
                 printer("[Syncing new rows for table {}]".format(table_name))
                 with Indent(printer):
 
-                    # get any new rows
-                    max_id = pull_missing_ids(table_name, cli_args, local_args, remote_connection, printer=printer)
+                    # get any new rows (no need to check them, the scan below will)
+                    max_id = pull_missing_ids(table_name, cli_args, local_args, remote_connection,
+                                              verify_mode='none', printer=printer)
 
-                if is_equal(remote_cursor, local_cursor, table_name, printer):
+                # new rows are often the only change, and one checksum costs less than a scan
+                # (if the counts and max ids matched above, the checksum already ran and nothing was pulled since)
+                if not counts_match and is_equal(remote_cursor, local_cursor, table_name, printer=printer):
                     printer("{} is identical on either side".format(table_name))
                     return
 
                 printer("[Scanning for diffs in table {}]".format(table_name))
-                with Indent(printer):
+                with Indent(printer), ExitStack() as stack, metrics.phase('scan'):
 
                     # find which id-ranges have changes that need syncing
-                    remote_max = get_max_md5_rows(remote_cursor, printer=printer)
-                    local_max = get_max_md5_rows(local_cursor, printer=printer)
-                    interval_size = min(remote_max, local_max, interval_size)
+                    remote_max = engine.max_rows(remote_cursor, printer=printer)
+                    local_max = engine.max_rows(local_cursor, printer=printer)
+
+                    # some engines don't care how many rows they hash at once
+                    if remote_max and local_max:
+                        max_rows = min(remote_max, local_max)
+                    else:
+                        max_rows = max_id + 1
+
+                    printer("[Examining table formats on either side]")
+                    with Indent(printer):
+                        columns = (examine_columns(local_cursor, table_name, policy=policy, printer=printer),
+                                   examine_columns(remote_cursor, table_name, policy=policy, printer=printer))
+                        if row_diffs:
+                            row_columns = (RowColumns(local_cursor, table_name, policy=policy, printer=printer),
+                                           RowColumns(remote_cursor, table_name, policy=policy, printer=printer))
+
+                    # with --also-into, the first target picks the size for every target, and only it measures
+                    # costs (the others' remote reads would mostly be answered from what it read, see fanout.py)
+                    tuner = None
+                    if interval_size == 'auto':
+                        if not shared.planned('interval_size'):
+                            tuner = IntervalTuner(local_args.database, table_name, engine, printer=printer)
+                        interval_size = shared.plan('interval_size',
+                                                    lambda : tuner.choose(remote_cursor, local_cursor, columns,
+                                                                          max_id, max_rows))
+                    elif remote_max and local_max:
+                        interval_size = min(max_rows, interval_size)
+
+                    cache = None
+                    if cache_fingerprints:
+                        cache = FingerprintCache(local_args.database, table_name, engine, columns, interval_size,
+                                                 verify=verify_local or getattr(cli_args, 'verify_local', False),
+                                                 printer=printer)
+
+                        # pull_missing_ids added or deleted rows beyond whichever max id was smaller
+                        cache.forget([Interval(min(local_max_id, max_id) + 1, float('inf'))])
+
+                    if local_workers or remote_workers:
+
+                        # pooled connections need the same group_concat_max_len as the ones above
+                        setup = lambda cursor : engine.max_rows(cursor, printer=printer)
+                        local_pool = stack.enter_context(ConnectionPool(LocalConnection, local_args,
+                                                                        local_workers or remote_workers,
+                                                                        setup=setup))
+                        remote_pool = stack.enter_context(ConnectionPool(RemoteConnection, remote_connection.args,
+                                                                         remote_workers or local_workers,
+                                                                         setup=setup))
+
+                        scan = lambda intervals : find_diff_intervals_concurrent(remote_pool, local_pool, table_name,
+                                                                                 intervals, columns=columns,
+                                                                                 engine=engine, cache=cache,
+                                                                                 printer=printer)
+                    else:
+                        scan = lambda intervals : find_diff_intervals(remote_cursor, local_cursor, table_name,
+                                                                      intervals, columns=columns, engine=engine,
+                                                                      cache=cache, printer=printer)
+
+                    if tuner:
+                        scan = tuner.timed(scan)
+
+                    # descending starts with intervals as wide as we can hash, otherwise start at the leaves
+                    # the same intervals for every target, so they ask the remote server the same questions
+                    rows = max_rows if fanout else interval_size
+                    if equi_depth:
+                        plan = lambda : plan_equi_depth(remote_connection, table_name, rows, printer=printer)
+                    else:
+                        plan = lambda : make_intervals(0, max_id + 1, rows, clip=bool(fanout))
+                    intervals = shared.plan('intervals', plan)
+
+                    if fanout:
+                        diff_intervals = find_diff_intervals_recursive(scan, intervals, interval_size,
+                                                                       fanout=fanout, printer=printer)
+                    else:
+                        diff_intervals = scan(intervals)
+
+                    if tuner:
+                        tuner.scanned(diff_intervals, max_id)
+
+    # one dump, delete, and load per transfer range, instead of per interval
+    transfer_ranges = coalesce_intervals(diff_intervals, gap=transfer_gap, max_size=transfer_max)
+
+    printer("[Transferring {} diffs in table {} as {} ranges]".format(len(diff_intervals),
+                                                                     table_name,
+                                                                     len(transfer_ranges)))
+    with Indent(printer), metrics.phase('transfer'), get_transfer(cli_args, local_args, remote_connection) as transfer:
+        metrics.count(intervals_transferred=len(diff_intervals), transfer_ranges=len(transfer_ranges))
+
+        for interval in transfer_ranges:
+
+            started = time.monotonic()
+            condition = 'id >= {} and id <= {}'.format(interval.start, interval.end)
 
-                    intervals = make_intervals(0, max_id, interval_size)
+            if row_diffs:
 
-                    diff_intervals = find_diff_intervals(remote_cursor, local_cursor, table_name, intervals,
-                                                         printer=printer)
+                # only the rows that differ
+                with LocalConnection(local_args) as local_connection:
+                    with local_connection.cursor() as local_cursor:
+                        with remote_connection.cursor() as remote_cursor:
+                            transfer_row_diffs(remote_cursor, local_cursor, table_name, row_columns, interval,
+                                               printer=printer)
+            else:
+                transfer.replace_range(table_name, condition, printer=printer)
 
-    printer("[Transferring for diffs in table {}]".format(table_name))
-    with Indent(printer):
+            if tuner:
+                tuner.transferred(interval.width(), time.monotonic() - started)
 
-        for interval in diff_intervals:
+    # remember the costs and local fingerprints for next time
+    if tuner:
+        tuner.save()
+    if cache:
+        cache.loaded(diff_intervals)
+        cache.save()
 
-            condition = 'id >= {} and id <= {}'.format(interval.start, interval.end)
+    # warn if not equal
+    with LocalConnection(local_args) as local_connection:
+        with local_connection.cursor() as local_cursor:
+            with remote_connection.cursor() as remote_cursor:
 
-            # dump remote data
-            mysqldump_data_remote(cli_args, table_name, condition, printer=printer)
+                # everything else matched during the scan, and only the transferred intervals were written to since
+                def recheck(mode):
+                    engine.max_rows(remote_cursor, printer=printer)
+                    engine.max_rows(local_cursor, printer=printer)
+                    if mode == 'incremental':
+                        intervals = diff_intervals
+                    else:
+                        intervals = shared.plan('sample', lambda : sample_intervals(0, max_id + 1, interval_size))
+                    return find_diff_intervals(remote_cursor, local_cursor, table_name, intervals, columns=columns,
+                                               engine=engine, printer=printer)
+
+                verify(remote_cursor, local_cursor, table_name, verify_mode, recheck=recheck, printer=printer)
+
+# for tables whose primary key isn't a single integer id (composite keys, uuids, varchars, ...)
+# the remote primary key is walked to find chunks of about chunk_rows rows, which are then
+# fingerprinted and transferred just like general_sync does with ranges of ids
+# up to transfer_max neighboring chunks are transferred at once
+@metrics.phase('keyset_sync')
+def keyset_sync(table_name, chunk_rows, cli_args, local_args, remote_connection, transfer_max=10,
+                policy=None, verify_mode=None, printer=Prindenter()):
 
-            # clear old rows from local
-            delete = 'delete from {} where {};'.format(table_name, condition)
-            with LocalConnection(local_args) as local_connection:
-                with local_connection.cursor() as cursor:
-                    show_do_query(cursor, delete, printer=printer)
+    with LocalConnection(local_args) as local_connection:
+        with local_connection.cursor() as local_cursor:
+            with remote_connection.cursor() as remote_cursor:
+
+                # there may not be an id column, so just compare row counts before checksumming
+                if is_equal(remote_cursor, local_cursor, table_name, id_col=None, printer=printer):
+                    printer("{} is identical on either side".format(table_name))
+                    return
+
+                printer("[Scanning for diffs in table {}]".format(table_name))
+                with Indent(printer), metrics.phase('scan'):
+
+                    key = get_primary_key(remote_cursor, table_name, printer=printer)
+                    if not key:
+                        raise ValueError("{} has no primary key to walk".format(table_name))
+
+                    remote_max = get_max_md5_rows(remote_cursor, printer=printer)
+                    local_max = get_max_md5_rows(local_cursor, printer=printer)
+                    chunk_rows = min(remote_max, local_max, chunk_rows)
+
+                    # the same chunks for every target, if fanning out (see fanout.py)
+                    chunks = shared.plan('chunks', lambda : plan_key_chunks(remote_connection, table_name, key,
+                                                                            chunk_rows, printer=printer))
+
+                    printer("[Examining table formats on either side]")
+                    with Indent(printer):
+                        columns = (examine_columns(local_cursor, table_name, policy=policy, printer=printer),
+                                   examine_columns(remote_cursor, table_name, policy=policy, printer=printer))
 
-            # load new rows into local
-            mysqlload_local(cli_args, table_name, printer=printer)
+                    diff_chunks = find_diff_intervals(remote_cursor, local_cursor, table_name, chunks,
+                                                      id_col=', '.join(key), columns=columns, printer=printer)
+
+    transfer_ranges = coalesce_key_intervals(diff_chunks, max_chunks=transfer_max)
+
+    printer("[Transferring {} diffs in table {} as {} ranges]".format(len(diff_chunks),
+                                                                     table_name,
+                                                                     len(transfer_ranges)))
+    with Indent(printer), metrics.phase('transfer'), get_transfer(cli_args, local_args, remote_connection) as transfer:
+        metrics.count(intervals_transferred=len(diff_chunks), transfer_ranges=len(transfer_ranges))
+
+        for chunk in transfer_ranges:
+            transfer.replace_range(table_name, chunk.condition(), printer=printer)
 
     # warn if not equal
     with LocalConnection(local_args) as local_connection:
         with local_connection.cursor() as local_cursor:
             with remote_connection.cursor() as remote_cursor:
-                warn_if_not_equal(remote_cursor, local_cursor, table_name, printer=printer)
+
+                def recheck(mode):
+                    get_max_md5_rows(remote_cursor, printer=printer)
+                    get_max_md5_rows(local_cursor, printer=printer)
+                    return find_diff_intervals(remote_cursor, local_cursor, table_name,
+                                               diff_chunks if mode == 'incremental'
+                                               else shared.plan('sample', lambda : sample(chunks)),
+                                               id_col=', '.join(key), columns=columns, printer=printer)
+
+                verify(remote_cursor, local_cursor, table_name, get_mode(cli_args, verify_mode), recheck=recheck,
+                       id_col=None, printer=printer)
+
+# for tables with an indexed column that gets bumped whenever a row changes (i.e. updated_at)
+# pulls the rows that changed since the last run and REPLACEs them locally.  The high-water mark is kept
+# in .mysqlslice/ between runs, and each run reaches back `overlap` seconds before it in case of
+# clock skew or transactions that committed late.
+# This can't see DELETEs, so the first run, and every `reconcile_every`th run after that (if set),
+# is a general_sync with interval_size instead
+@metrics.phase('pull_updated_rows')
+def pull_updated_rows(table_name, cli_args, local_args, remote_connection, updated_col='updated_at', overlap=300,
+                      reconcile_every=None, interval_size=1000, printer=Prindenter()):
+
+    names = ('watermark', local_args.database, table_name)
+    state = load_state(*names, default={})
+    runs = state.get('runs', 0) + 1
+
+    # note the mark before pulling anything, rows that change during the pull will just be pulled again next time
+    with remote_connection.cursor() as cursor:
+        printer("Finding max({}) for {}.{}".format(updated_col, table_name, cursor.connection.db))
+        with Indent(printer):
+            target = 'max({})'.format(updated_col)
+            result = show_do_query(cursor, 'select {} from {};'.format(target, table_name), printer=printer)
+            watermark = result[0][target]
+
+    if 'watermark' not in state or (reconcile_every and runs % reconcile_every == 0):
+        printer("[Reconciling {} in full (run {})]".format(table_name, runs))
+        with Indent(printer):
+            general_sync(table_name, interval_size, cli_args, local_args, remote_connection, printer=printer)
+
+    elif state['watermark'] is None:
+        printer("{} was empty last time, pulling everything".format(table_name))
+        with get_transfer(cli_args, local_args, remote_connection) as transfer:
+            transfer.copy(table_name, 'TRUE', replace=True, printer=printer)
+
+    else:
+        printer("[Pulling rows of {} updated since {} (less {} seconds)]".format(table_name,
+                                                                               state['watermark'],
+                                                                               overlap))
+        with Indent(printer):
+            condition = "{} > '{}' - INTERVAL {} SECOND".format(updated_col, state['watermark'], overlap)
+            with get_transfer(cli_args, local_args, remote_connection) as transfer:
+                transfer.copy(table_name, condition, replace=True, printer=printer)
+
+    save_state({ 'watermark' : str(watermark) if watermark is not None else None,
+                 'runs'      : runs },
+               *names)
+    printer("{} is up to date as of {}".format(table_name, watermark))
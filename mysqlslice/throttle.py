@@ -0,0 +1,194 @@
+import time
+import threading
+from contextlib import contextmanager
+
+import pymysql
+
+from mysqlslice.mysql import RemoteConnection
+from mysqlslice.metrics import metrics
+
+# Throttle
+# ========
+
+# Keeps the remote server within a load budget, so syncs can run while it's busy.
+# Before each remote fingerprint query or dump it checks (at most every check_every seconds) how many
+# threads are running on the remote server and, if it's a replica, how far behind it is.  Over budget,
+# everything waits and then continues at half speed.  Under budget, speed creeps back up.  Our own
+# query latencies count too: a remote query that takes longer than max_query_seconds slows things down.
+#
+# "Speed" is two things: a factor for batch sizes (see scale()), and how many remote operations may run
+# at once, across all threads.  max_remote_ops caps the latter for good, however fast things are going
+# (with --jobs, that's how many steps may be talking to the remote server at once).  Separately, dumps
+# are held to max_bytes_per_second.
+#
+#     throttle.configure(remote_args, max_threads_running=20)
+#     with throttle.remote():
+#         engine.fingerprint(remote_cursor, ...)
+#
+# Unconfigured, it does nothing.
+
+class Throttle:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+        # only one thread polls the server at a time, the rest wait for its answer
+        self.polling = threading.Lock()
+
+        self.monitor = None
+        self.configure(None)
+
+    def configure(self, remote_args, max_threads_running=None, max_replica_lag=None, max_query_seconds=None,
+                  max_bytes_per_second=None, max_remote_ops=None, check_every=5, min_factor=0.05):
+        self.close()
+
+        self.remote_args = remote_args
+        self.max_threads_running = max_threads_running
+        self.max_replica_lag = max_replica_lag
+        self.max_query_seconds = max_query_seconds
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_remote_ops = max_remote_ops
+        self.check_every = check_every
+        self.min_factor = min_factor
+
+        self.watching = remote_args is not None and (max_threads_running is not None or max_replica_lag is not None)
+
+        self.factor = 1.0          # batch sizes are scaled by this
+        self.allowed = max_remote_ops    # remote operations at once (None for no limit)
+        self.in_flight = 0
+        self.checked = None        # when the server was last polled
+        self.recovered = None      # when speed last crept up after fast queries
+        self.overloaded = False
+        self.next_free = 0         # when the next dumped byte is allowed
+
+    def close(self):
+        if self.monitor:
+            self.monitor.__exit__(None, None, None)
+            self.monitor = None
+
+    # Threads_running, and seconds behind the source (None if the remote server isn't a replica)
+    def poll(self):
+        if not self.monitor:
+            self.monitor = RemoteConnection(self.remote_args).__enter__()
+
+        with self.monitor.cursor() as cursor:
+            cursor.execute("show global status like 'Threads_running';")
+            threads = int(cursor.fetchall()[0]['Value'])
+
+            lag = None
+            if self.max_replica_lag is not None:
+                try:
+                    cursor.execute('show replica status;')
+                except pymysql.err.ProgrammingError:
+                    # before MySQL 8.0.22
+                    cursor.execute('show slave status;')
+                for row in cursor.fetchall():
+                    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+
+        metrics.count(throttle_checks=1)
+        return threads, lag
+
+    def over_budget(self, threads, lag):
+        if self.max_threads_running is not None and threads > self.max_threads_running:
+            return True
+        if self.max_replica_lag is not None and lag is not None and lag > self.max_replica_lag:
+            return True
+        return False
+
+    # halve the speed (call with self.lock held)
+    def slow_down(self):
+        self.factor = max(self.min_factor, self.factor / 2)
+        self.allowed = max(1, (self.allowed or self.in_flight + 1) // 2)
+        metrics.count(throttle_slowdowns=1)
+
+    # a bit faster, back to full speed eventually (call with self.lock held)
+    def speed_up(self):
+        self.factor = min(1.0, self.factor + 0.1)
+        if self.allowed is not None:
+            if self.factor >= 1.0:
+                self.allowed = self.max_remote_ops
+            else:
+                self.allowed = min(self.allowed + 1, self.max_remote_ops or self.allowed + 1)
+        self.condition.notify_all()
+
+    # without polling, fast queries are the only sign that things are fine again
+    # so speed up after them, but no more often than polling would (call with self.lock held)
+    def recover(self):
+        now = time.monotonic()
+        if self.recovered is None or now - self.recovered >= self.check_every:
+            self.recovered = now
+            self.speed_up()
+
+    # wait until the remote server is within budget
+    def wait_for_budget(self):
+        if not self.watching:
+            return
+
+        with self.polling:
+            while True:
+                now = time.monotonic()
+                if not self.overloaded and self.checked is not None and now - self.checked < self.check_every:
+                    return
+
+                threads, lag = self.poll()
+                self.checked = now
+                over = self.over_budget(threads, lag)
+
+                with self.lock:
+                    if over:
+                        self.slow_down()
+                    else:
+                        self.speed_up()
+
+                self.overloaded = over
+                if not over:
+                    return
+
+                # give the server a moment before asking again
+                metrics.count(throttle_waits=1, throttle_seconds=self.check_every)
+                time.sleep(self.check_every)
+
+    # wrap each remote fingerprint query or dump in this
+    # with observe, the time it takes counts against max_query_seconds
+    @contextmanager
+    def remote(self, observe=True):
+        self.wait_for_budget()
+
+        with self.condition:
+            while self.allowed is not None and self.in_flight >= self.allowed:
+                self.condition.wait()
+            self.in_flight += 1
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self.condition:
+                self.in_flight -= 1
+                if observe and self.max_query_seconds is not None:
+                    if elapsed > self.max_query_seconds:
+                        self.slow_down()
+                    elif not self.watching:
+                        self.recover()
+                self.condition.notify_all()
+
+    # a batch size, scaled down while the remote server is busy
+    def scale(self, size):
+        return max(1, int(size * self.factor))
+
+    # call after moving this many bytes from the remote server, it sleeps if that was too many too fast
+    def transferred(self, size):
+        if not self.max_bytes_per_second:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.next_free = max(self.next_free, now) + size / self.max_bytes_per_second
+            delay = self.next_free - now
+
+        if delay > 0:
+            metrics.count(throttle_seconds=delay)
+            time.sleep(delay)
+
+throttle = Throttle()
@@ -0,0 +1,295 @@
+from pymysql.cursors import SSCursor
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG, show_do_query, mysqldump_data_remote, mysqlload_local
+from mysqlslice.mysql import LocalConnection
+from mysqlslice.fingerprint import range_condition, get_columns, key_names, convert_column, ColumnPolicy
+from mysqlslice.metrics import metrics
+from mysqlslice.throttle import throttle
+
+# Row-Level Transfers
+# ===================
+
+# Once an interval is known to differ, the usual thing is to dump it, delete it locally, and load it again.
+# That moves every row in the interval, even if only one of them changed.  Instead, this compares
+# (id, md5 of the row) pairs from either side and only moves the rows that actually differ:
+# missing rows are REPLACEd locally, changed ones are updated, and rows that are gone upstream are DELETEd.
+# It costs an extra query per side per interval, so it pays off when intervals are wide and changes are few.
+#
+# If the table has a ColumnPolicy (see fingerprint.py), digested columns get their own digests here,
+# so a changed row only brings along the big columns that actually changed.  Excluded columns are
+# left alone, except in rows that are new.
+
+# ids per REPLACE, UPDATE, or DELETE
+batch_size = 1000
+
+# how one side's rows get fingerprinted and copied, given a ColumnPolicy
+class RowColumns:
+    def __init__(self, cursor, table_name, policy=None, printer=Prindenter()):
+        policy = policy or ColumnPolicy()
+        columns = get_columns(cursor, table_name, printer=printer)
+        keys = key_names(cursor, table_name, printer=printer)
+
+        self.names = [ column['COLUMN_NAME'] for column in columns ]
+        self.excluded = [ name for name in self.names if name in policy.exclude and name not in keys ]
+
+        # compared as part of the row's md5 (the primary key always is, see ColumnPolicy)
+        self.compared = [ convert_column(column) for column in columns
+                          if column['COLUMN_NAME'] in keys
+                          or (policy.compares(column) and not policy.digests(column)) ]
+
+        # compared on their own, so they can be left behind if they haven't changed
+        self.digested = { column['COLUMN_NAME'] : convert_column(column, policy) for column in columns
+                          if column['COLUMN_NAME'] not in keys and policy.compares(column) and policy.digests(column) }
+
+# md5 of each row in the interval, and the digest of each digested column, by id
+def get_row_fingerprints(cursor, table_name, row_columns, interval, id_col='id', printer=Prindenter()):
+
+    printer(lambda : "[Fingerprinting rows of " + cursor.connection.db
+            + ".{} where {} in {}]".format(table_name, id_col, interval), level=DEBUG)
+    with Indent(printer):
+
+        if row_columns.compared:
+            row_fingerprint = 'MD5(CONCAT({}))'.format(",".join(row_columns.compared))
+        else:
+            row_fingerprint = "''"
+
+        digests = ''.join(', {} AS `{}`'.format(conversion, name) for name, conversion in row_columns.digested.items())
+
+        result = show_do_query(cursor,
+                """
+                SELECT {} AS id, {} AS row_fingerprint{}
+                FROM {}
+                WHERE {};
+                """.format(id_col,
+                           row_fingerprint,
+                           digests,
+                           table_name,
+                           range_condition(interval, id_col=id_col)),
+                printer=printer)
+
+        return { row['id'] : (row['row_fingerprint'], { name : row[name] for name in row_columns.digested })
+                 for row in result }
+
+# which ids need to be copied from the remote side, which need to be updated (and which digested
+# columns have to come with them), and which need to be deleted from the local side
+def diff_row_fingerprints(remote, local):
+    inserts = sorted(id for id in remote if id not in local)
+    deletes = sorted(id for id in local if id not in remote)
+
+    updates = {}
+    for id in sorted(remote):
+        if id in local and remote[id] != local[id]:
+            remote_digests = remote[id][1]
+            local_digests = local[id][1]
+            updates[id] = tuple(name for name in remote_digests if remote_digests[name] != local_digests.get(name))
+
+    return inserts, updates, deletes
+
+# smaller while the remote server is busy (see throttle.py)
+def batches(ids, size=None):
+    size = size or throttle.scale(batch_size)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def id_list(ids):
+    return ', '.join(str(id) for id in ids)
+
+def quoted(columns):
+    return ', '.join('`{}`'.format(column) for column in columns)
+
+# copy these rows from the remote side, replacing whatever the local side has for them
+def replace_rows(remote_cursor, local_cursor, table_name, ids, id_col='id', printer=Prindenter()):
+
+    for batch in batches(ids):
+        with throttle.remote():
+            rows = show_do_query(remote_cursor,
+                                 'select * from {} where {} in ({});'.format(table_name, id_col, id_list(batch)),
+                                 printer=printer)
+        if not rows:
+            continue
+
+        columns = list(rows[0].keys())
+        replace = 'replace into {} ({}) values ({})'.format(table_name, quoted(columns),
+                                                            ', '.join(['%s'] * len(columns)))
+        values = [ tuple(row[c] for c in columns) for row in rows ]
+
+        # pymysql rewrites this into multi-row REPLACE statements
+        show_do_query(local_cursor, replace,
+                      do=lambda cursor, query: cursor.executemany(query, values),
+                      get=lambda cursor: cursor.rowcount,
+                      printer=printer)
+
+# copy just these columns of these rows (which are already present locally) from the remote side
+def update_rows(remote_cursor, local_cursor, table_name, ids, columns, id_col='id', printer=Prindenter()):
+
+    for batch in batches(ids):
+        with throttle.remote():
+            rows = show_do_query(remote_cursor,
+                                 'select {} from {} where {} in ({});'.format(quoted(columns), table_name, id_col,
+                                                                              id_list(batch)),
+                                 printer=printer)
+        if not rows:
+            continue
+
+        # every row exists already, so this only ever takes the UPDATE branch
+        upsert = 'insert into {} ({}) values ({}) on duplicate key update {}'.format(
+                     table_name, quoted(columns), ', '.join(['%s'] * len(columns)),
+                     ', '.join('`{0}` = values(`{0}`)'.format(column) for column in columns))
+        values = [ tuple(row[c] for c in columns) for row in rows ]
+
+        show_do_query(local_cursor, upsert,
+                      do=lambda cursor, query: cursor.executemany(query, values),
+                      get=lambda cursor: cursor.rowcount,
+                      printer=printer)
+
+def delete_rows(local_cursor, table_name, ids, id_col='id', printer=Prindenter()):
+    for batch in batches(ids):
+        show_do_query(local_cursor,
+                      'delete from {} where {} in ({});'.format(table_name, id_col, id_list(batch)),
+                      printer=printer)
+
+# make the local rows in this interval match the remote ones, moving only the rows that differ
+# columns is a pair of RowColumns (local, remote)
+def transfer_row_diffs(remote_cursor, local_cursor, table_name, columns, interval, id_col='id',
+                       printer=Prindenter()):
+
+    local_columns, remote_columns = columns
+    local = get_row_fingerprints(local_cursor, table_name, local_columns, interval, id_col=id_col, printer=printer)
+    with throttle.remote():
+        remote = get_row_fingerprints(remote_cursor, table_name, remote_columns, interval, id_col=id_col,
+                                      printer=printer)
+    inserts, updates, deletes = diff_row_fingerprints(remote, local)
+
+    printer("{}: {} rows to copy, {} to update, {} to delete, {} unchanged".format(
+                interval, len(inserts), len(updates), len(deletes), len(remote) - len(inserts) - len(updates)))
+    metrics.count(rows_replaced=len(inserts), rows_updated=len(updates), rows_deleted=len(deletes))
+
+    replace_rows(remote_cursor, local_cursor, table_name, inserts, id_col=id_col, printer=printer)
+
+    # everything but excluded and digested columns, plus whichever digested ones changed
+    always = [ name for name in remote_columns.names
+               if name not in remote_columns.excluded and name not in remote_columns.digested ]
+    by_columns = {}
+    for id, changed in updates.items():
+        by_columns.setdefault(changed, []).append(id)
+    for changed, ids in by_columns.items():
+        update_rows(remote_cursor, local_cursor, table_name, ids, always + list(changed), id_col=id_col,
+                    printer=printer)
+
+    delete_rows(local_cursor, table_name, deletes, id_col=id_col, printer=printer)
+
+# Transfer Backends
+# =================
+
+# Moving a range of rows from the remote side to the local one.  Either backend can:
+#     copy(table_name, condition, replace=False)   add the remote rows matching condition (REPLACE-ing them if asked)
+#     replace_range(table_name, condition)         make the local rows matching condition match the remote ones
+#                                                  (or delete_condition, if the local side should lose more rows)
+# and is used like so:
+#
+#     with get_transfer(cli_args, local_args, remote_connection) as transfer:
+#         transfer.replace_range('bar', 'id >= 1 and id <= 1000', printer=printer)
+#
+# --transfer (or backend=...) picks one.
+
+# mysqldump into <table>.sql, then mysql to load it: a process, a file, and a login per range,
+# but it's what we've always done and it leaves the dump behind for a look afterwards
+class DumpTransfer:
+    def __init__(self, cli_args, local_args, remote_connection):
+        self.cli_args = cli_args
+        self.local_args = local_args
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def copy(self, table_name, condition, replace=False, printer=Prindenter()):
+        mysqldump_data_remote(self.cli_args, table_name, condition, replace=replace, printer=printer)
+        mysqlload_local(self.cli_args, table_name, printer=printer)
+
+    def replace_range(self, table_name, condition, delete_condition=None, printer=Prindenter()):
+
+        # dump remote data
+        mysqldump_data_remote(self.cli_args, table_name, condition, printer=printer)
+
+        # clear old rows from local
+        delete = 'delete from {} where {};'.format(table_name, delete_condition or condition)
+        with LocalConnection(self.local_args) as local_connection:
+            with local_connection.cursor() as cursor:
+                show_do_query(cursor, delete, printer=printer)
+
+        # load new rows into local
+        mysqlload_local(self.cli_args, table_name, printer=printer)
+
+# stream rows out of the remote connection we already have (with an unbuffered cursor, so they
+# needn't fit in memory) and into one local connection as multi-row INSERTs, without touching disk
+class StreamTransfer:
+    def __init__(self, cli_args, local_args, remote_connection, batch_rows=1000):
+        self.local_args = local_args
+        self.remote_connection = remote_connection
+        self.batch_rows = batch_rows
+
+    def __enter__(self):
+        self.local_connection = LocalConnection(self.local_args).__enter__()
+        self.local_cursor = self.local_connection.cursor()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.local_cursor.close()
+        self.local_connection.__exit__(type, value, traceback)
+
+    def copy(self, table_name, condition, replace=False, printer=Prindenter()):
+
+        printer('[Streaming {} from {} where {}]'.format(table_name, self.remote_connection.args.host, condition))
+        with Indent(printer):
+
+            select = 'select * from {} where {};'.format(table_name, condition)
+            copied = 0
+            with throttle.remote(observe=False), self.remote_connection.cursor(SSCursor) as stream:
+                printer(select, level=DEBUG)
+                stream.execute(select)
+
+                columns = [ column[0] for column in stream.description ]
+                insert = '{} into {} ({}) values ({})'.format('replace' if replace else 'insert',
+                                                              table_name,
+                                                              ', '.join('`{}`'.format(c) for c in columns),
+                                                              ', '.join(['%s'] * len(columns)))
+                while True:
+                    rows = stream.fetchmany(throttle.scale(self.batch_rows))
+                    if not rows:
+                        break
+
+                    # about as many bytes as went over the wire
+                    if throttle.max_bytes_per_second:
+                        throttle.transferred(sum(len(repr(value)) for row in rows for value in row))
+
+                    # pymysql rewrites this into multi-row statements
+                    show_do_query(self.local_cursor, insert,
+                                  do=lambda cursor, query: cursor.executemany(query, rows),
+                                  get=lambda cursor: cursor.rowcount,
+                                  printer=printer)
+                    copied += len(rows)
+
+            metrics.count(rows_streamed=copied)
+            printer('{} rows'.format(copied))
+
+    # in one transaction, so readers see the old rows or the new ones but never neither
+    def replace_range(self, table_name, condition, delete_condition=None, printer=Prindenter()):
+        show_do_query(self.local_cursor, 'start transaction;', printer=printer)
+        try:
+            delete = 'delete from {} where {};'.format(table_name, delete_condition or condition)
+            show_do_query(self.local_cursor, delete, printer=printer)
+            self.copy(table_name, condition, printer=printer)
+        except:
+            show_do_query(self.local_cursor, 'rollback;', printer=printer)
+            raise
+        show_do_query(self.local_cursor, 'commit;', printer=printer)
+
+backends = { 'dump'   : DumpTransfer,
+             'stream' : StreamTransfer }
+
+def get_transfer(cli_args, local_args, remote_connection, backend=None):
+    backend = backend or getattr(cli_args, 'transfer', None) or 'dump'
+    return backends[backend](cli_args, local_args, remote_connection)
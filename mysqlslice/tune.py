@@ -0,0 +1,195 @@
+import time
+
+from mysqlslice.cli import Prindenter, Indent, DEBUG
+from mysqlslice.math import Interval
+from mysqlslice.state import load_state, save_state
+
+# Tuning Interval Sizes
+# =====================
+
+# general_sync(..., interval_size='auto', ...) picks its own interval size.
+#
+# Small intervals mean more fingerprint queries, large ones mean more unchanged rows come along
+# with each changed one.  Which is cheaper depends on the servers, the network, and the workload,
+# so instead of guessing, each run measures:
+#
+#     query_seconds    the cost of fingerprinting an interval, apart from the rows in it
+#                      (timed on an empty interval, on both sides, before the scan)
+#     scan_seconds     the cost of hashing each id, from the time the scan actually took
+#     transfer         the fixed and per-id cost of dumping, deleting, and loading a range
+#                      (fit to the ranges transferred so far)
+#     density          the chance that a given id changed since the last run
+#                      (from the fraction of intervals that differed)
+#
+# and keeps them in .mysqlslice/ for next time.  For a table spanning `ids` ids and size `s`:
+#
+#     scan       = (ids / s) * query_seconds + ids * scan_seconds
+#     differing  = (ids / s) * (1 - (1 - density) ^ s)
+#     transfer   = differing * (transfer_fixed + s * transfer_per_id)
+#
+# and the chosen size is whichever minimizes scan + transfer, up to the largest interval
+# that can be hashed at once.  With nothing measured yet, default_size is used.
+
+default_size = 1000
+
+# measurements are blended with earlier ones, so one odd run doesn't swing things too far
+weight = 0.5
+
+# how many transfers to remember for fitting the transfer cost
+remembered_transfers = 100
+
+def blend(old, new):
+    if old is None:
+        return new
+    return old * (1 - weight) + new * weight
+
+# least squares fit of y = intercept + slope * x, neither of which may be negative
+def fit_line(points):
+    if not points:
+        return None
+
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, y in points)
+
+    if var_x > 0:
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+        intercept = mean_y - slope * mean_x
+        if slope >= 0 and intercept >= 0:
+            return intercept, slope
+
+    # all the same size, or too noisy to separate: call it all per-id cost
+    total_x = sum(x for x, y in points)
+    return 0.0, (sum(y for x, y in points) / total_x if total_x else 0.0)
+
+# the chance that any one id changed, given that `differing` of `intervals` intervals of `size` ids did
+def estimate_density(differing, intervals, size):
+    if not intervals:
+        return None
+    fraction = min(differing, intervals - 0.5) / intervals
+    return 1 - (1 - fraction) ** (1 / size)
+
+def estimate_seconds(size, ids, costs):
+    intervals = ids / size
+    scan = intervals * costs['query_seconds'] + ids * costs['scan_seconds']
+    differing = intervals * (1 - (1 - costs['density']) ** size)
+    transfer = differing * (costs['transfer_fixed'] + size * costs['transfer_per_id'])
+    return scan + transfer
+
+# sizes from 1 to max_size, each about a quarter bigger than the last
+def candidate_sizes(max_size):
+    sizes = []
+    size = 1
+    while size < max_size:
+        sizes.append(size)
+        size = max(size + 1, int(size * 1.25))
+    sizes.append(max_size)
+    return sizes
+
+class IntervalTuner:
+    def __init__(self, database, table_name, engine, id_col='id', printer=Prindenter()):
+        self.names = ('tuning', database, table_name)
+        self.table_name = table_name
+        self.engine = engine
+        self.id_col = id_col
+        self.printer = printer
+
+        # costs depend on how fingerprints are taken, so start over if that changed
+        self.state = load_state(*self.names, default={})
+        if self.state.get('engine') != type(engine).__name__:
+            self.state = { 'engine' : type(engine).__name__ }
+
+        self.size = None
+        self.scan_seconds = 0
+        self.scanned_intervals = 0
+        self.scanned_ids = 0
+
+    # time fingerprinting an interval with no rows in it, on both sides
+    def probe(self, remote_cursor, local_cursor, columns, max_id, tries=3):
+        empty = [Interval(max_id + 1, max_id + 1)]
+        per_query = getattr(self.engine, 'buckets', 1)
+
+        best = None
+        for _ in range(tries):
+            started = time.monotonic()
+            self.engine.fingerprint(local_cursor, self.table_name, columns[0], empty, id_col=self.id_col,
+                                    printer=self.printer)
+            self.engine.fingerprint(remote_cursor, self.table_name, columns[1], empty, id_col=self.id_col,
+                                    printer=self.printer)
+            elapsed = time.monotonic() - started
+            best = elapsed if best is None else min(best, elapsed)
+
+        # engines that hash many intervals per query pay the round trip once per batch
+        return best / per_query
+
+    def costs(self):
+        transfer = fit_line(self.state.get('transfers', []))
+
+        # nothing has changed yet, so nothing has been transferred yet
+        if transfer is None and self.state.get('density') == 0:
+            transfer = (0.0, 0.0)
+
+        if None in (self.state.get('query_seconds'), self.state.get('scan_seconds'),
+                    self.state.get('density'), transfer):
+            return None
+
+        return { 'query_seconds'   : self.state['query_seconds'],
+                 'scan_seconds'    : self.state['scan_seconds'],
+                 'density'         : self.state['density'],
+                 'transfer_fixed'  : transfer[0],
+                 'transfer_per_id' : transfer[1] }
+
+    # pick an interval size for a table spanning ids 0 through max_id, hashing at most max_size at once
+    def choose(self, remote_cursor, local_cursor, columns, max_id, max_size):
+
+        self.printer("[Tuning interval size for {}]".format(self.table_name))
+        with Indent(self.printer):
+
+            query_seconds = self.probe(remote_cursor, local_cursor, columns, max_id)
+            self.state['query_seconds'] = blend(self.state.get('query_seconds'), query_seconds)
+
+            costs = self.costs()
+            if costs is None:
+                self.size = min(default_size, max_size)
+                self.printer("nothing measured yet, starting with {}".format(self.size))
+                return self.size
+
+            ids = max_id + 1
+            self.size = min(candidate_sizes(max_size), key=lambda size : estimate_seconds(size, ids, costs))
+
+            self.printer(lambda : "costs: {}".format(costs), level=DEBUG)
+            self.printer("using intervals of {}, estimated {:.1f}s".format(self.size,
+                                                                         estimate_seconds(self.size, ids, costs)))
+            return self.size
+
+    # wrap a scan function so its time and work get measured
+    def timed(self, scan):
+        def timed_scan(intervals):
+            intervals = list(intervals)
+            started = time.monotonic()
+            diffs = scan(intervals)
+            self.scan_seconds += time.monotonic() - started
+            self.scanned_intervals += len(intervals)
+            self.scanned_ids += sum(interval.width() for interval in intervals)
+            return diffs
+        return timed_scan
+
+    # call once the scan is done, with the intervals that differed
+    def scanned(self, diff_intervals, max_id):
+        if self.scanned_ids:
+            per_id = (self.scan_seconds - self.scanned_intervals * self.state['query_seconds']) / self.scanned_ids
+            self.state['scan_seconds'] = blend(self.state.get('scan_seconds'), max(per_id, 0.0))
+
+        leaves = (max_id + 1 + self.size - 1) // self.size
+        density = estimate_density(len(diff_intervals), leaves, self.size)
+        if density is not None:
+            self.state['density'] = blend(self.state.get('density'), density)
+
+    def transferred(self, ids, seconds):
+        transfers = self.state.setdefault('transfers', [])
+        transfers.append([ids, seconds])
+        del transfers[:-remembered_transfers]
+
+    def save(self):
+        save_state(self.state, *self.names)
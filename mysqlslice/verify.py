@@ -0,0 +1,110 @@
+import random
+
+from mysqlslice.cli import Prindenter, Indent, QUIET, show_do_query
+from mysqlslice.math import Interval
+from mysqlslice.metrics import metrics
+from mysqlslice.throttle import throttle
+
+# Verification
+# ============
+
+# CHECKSUM TABLE reads the whole table on both servers, which can cost more than the sync did.
+# So the cheap question comes first: if the row counts or max ids differ, the tables differ, and
+# there's no need to checksum anything.  After a sync, how hard to look is up to the mode:
+#
+#     none          don't
+#     sampled       fingerprint a few random intervals (plus the row counts and max ids)
+#     incremental   fingerprint again just the intervals that were transferred--the rest matched
+#                   during this run's scan and nothing has written to them since (plus the counts and max ids)
+#     full          CHECKSUM TABLE on both sides
+#
+# Strategies that don't scan by interval only have the counts and max ids to go on, except in full mode.
+
+modes = ['none', 'sampled', 'incremental', 'full']
+default_mode = 'incremental'
+
+# intervals to fingerprint in sampled mode
+sample_size = 20
+
+# an explicit mode wins, then --verify, then the default
+def get_mode(cli_args, mode=None):
+    return mode or getattr(cli_args, 'verify', None) or default_mode
+
+# row count and max id (or just the count, if there's no id_col)
+def get_summary(cursor, table_name, id_col='id', printer=Prindenter()):
+    if id_col:
+        query = 'select count(*) as row_count, max({}) as max_id from {};'.format(id_col, table_name)
+    else:
+        query = 'select count(*) as row_count from {};'.format(table_name)
+    return show_do_query(cursor, query, printer=printer)[0]
+
+@metrics.phase('summary')
+def summaries_match(remote_cursor, local_cursor, table_name, id_col='id', printer=Prindenter()):
+    printer("[Comparing row counts for {}]".format(table_name))
+    with Indent(printer):
+        with throttle.remote(observe=False):
+            remote = get_summary(remote_cursor, table_name, id_col=id_col, printer=printer)
+        local = get_summary(local_cursor, table_name, id_col=id_col, printer=printer)
+        return remote == local
+
+@metrics.phase('checksum')
+def checksums_match(remote_cursor, local_cursor, table_name, printer=Prindenter()):
+    printer("[Checking table equality for {}]".format(table_name))
+
+    with Indent(printer):
+        get_checksum = 'checksum table {};'.format(table_name)
+
+        # a whole-table read, so it waits for the load budget but isn't timed against it (see throttle.py)
+        with throttle.remote(observe=False):
+            result = show_do_query(remote_cursor, get_checksum, printer=printer)
+        remote_checksum = result[0]['Checksum']
+
+        result = show_do_query(local_cursor, get_checksum, printer=printer)
+        local_checksum = result[0]['Checksum']
+
+        return remote_checksum == local_checksum
+
+# is anything different?  Only checksums if the counts and max ids can't tell.
+def is_equal(remote_cursor, local_cursor, table_name, id_col='id', printer=Prindenter()):
+    if not summaries_match(remote_cursor, local_cursor, table_name, id_col=id_col, printer=printer):
+        return False
+    return checksums_match(remote_cursor, local_cursor, table_name, printer=printer)
+
+def warn_if_not_equal(remote_cursor, local_cursor, table_name, id_col='id', printer=Prindenter()):
+    if is_equal(remote_cursor, local_cursor, table_name, id_col=id_col, printer=printer):
+        printer("{} is identical on either side".format(table_name))
+    else:
+        printer("WARNING: {} differs, even after sync!".format(table_name), level=QUIET)
+
+# a few intervals, for sampled mode
+def sample(intervals, count=sample_size):
+    intervals = list(intervals)
+    return random.sample(intervals, min(count, len(intervals)))
+
+# a few of the intervals that make_intervals(start, end, size) would make, without making all of them
+def sample_intervals(start, end, size, count=sample_size):
+    positions = range(start, end, size)
+    return [ Interval(x, min(x + size, end) - 1) for x in sorted(random.sample(positions, min(count, len(positions)))) ]
+
+# check the sync as hard as `mode` says to
+# recheck(mode) fingerprints whichever intervals that mode calls for and returns those that still differ
+def verify(remote_cursor, local_cursor, table_name, mode, recheck=None, id_col='id', printer=Prindenter()):
+
+    if mode == 'none':
+        return
+
+    if mode == 'full':
+        warn_if_not_equal(remote_cursor, local_cursor, table_name, id_col=id_col, printer=printer)
+        return
+
+    equal = summaries_match(remote_cursor, local_cursor, table_name, id_col=id_col, printer=printer)
+    if equal and recheck:
+        printer("[Fingerprinting {} intervals of {} again]".format(mode, table_name))
+        with Indent(printer):
+            differing = recheck(mode)
+            equal = not differing
+
+    if equal:
+        printer("{} looks identical on either side ({} verification)".format(table_name, mode))
+    else:
+        printer("WARNING: {} differs, even after sync!".format(table_name), level=QUIET)
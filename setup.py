@@ -8,12 +8,21 @@ setup(name='mysqlslice',
       packages=['mysqlslice'],
       python_requires= '>=3',
       install_requires=['sh', 'pymysql'],
+      extras_require={
+
+          # for mysqlslice.binlog
+          'binlog' : ['mysql-replication']
+
+          },
       entry_points={'console_scripts' : [
 
           # sync data remote -> local
           'pull_slice = mysqlslice.slice:pull',
 
           # sync schema remote -> local
-          'pull_schema = mysqlslice.schema:pull'
+          'pull_schema = mysqlslice.schema:pull',
+
+          # time the sync strategies against a synthetic table
+          'bench_slice = mysqlslice.bench:bench'
 
           ]})
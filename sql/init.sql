@@ -142,6 +142,34 @@ create table baz (id int not null auto_increment,
 insert into baz (val) values
 (10), (11), (12), (13), (14), (15), (16), (17), (18), (19);
 
+-- a table without an id column, keyed by a name and a number instead
+create table qux (name varchar(20) not null,
+                  seq int not null,
+                  val int,
+                  primary key (name, seq));
+
+insert into qux (name, seq, val) values
+('ant', 1, 10), ('ant', 2, 20), ('ant', 3, 30), ('ant', 4, 40), ('ant', 5, 50),
+('ant', 6, 60), ('ant', 7, 70), ('ant', 8, 80), ('ant', 9, 90), ('ant', 10, 100),
+('bee', 1, 10), ('bee', 2, 20), ('bee', 3, 30), ('bee', 4, 40), ('bee', 5, 50),
+('bee', 6, 60), ('bee', 7, 70), ('bee', 8, 80), ('bee', 9, 90), ('bee', 10, 100),
+('cat', 1, 10), ('cat', 2, 20), ('cat', 3, 30), ('cat', 4, 40), ('cat', 5, 50),
+('cat', 6, 60), ('cat', 7, 70), ('cat', 8, 80), ('cat', 9, 90), ('cat', 10, 100);
+
+-- a table whose rows note when they last changed, so only the rows that changed need pulling
+create table quux (id int not null auto_increment,
+                   val int,
+                   updated_at timestamp not null default current_timestamp on update current_timestamp,
+                   primary key (id),
+                   key (updated_at));
+
+insert into quux (val) values
+(100), (101), (102), (103), (104), (105), (106), (107), (108), (109),
+(110), (111), (112), (113), (114), (115), (116), (117), (118), (119);
+
+-- as if they changed long ago
+update quux set updated_at = '2020-01-01 00:00:00';
+
 create database things_downstream;
 use things_downstream;
 
@@ -286,6 +314,34 @@ use things_downstream;
     insert into baz (val) values
     (10), (11), (12), (13), (14), (15), (16), (17), (18), (19);
 
+    -- a table without an id column, keyed by a name and a number instead
+    create table qux (name varchar(20) not null,
+                      seq int not null,
+                      val int,
+                      primary key (name, seq));
+
+    insert into qux (name, seq, val) values
+    ('ant', 1, 10), ('ant', 2, 20), ('ant', 3, 30), ('ant', 4, 40), ('ant', 5, 50),
+    ('ant', 6, 60), ('ant', 7, 70), ('ant', 8, 80), ('ant', 9, 90), ('ant', 10, 100),
+    ('bee', 1, 10), ('bee', 2, 20), ('bee', 3, 30), ('bee', 4, 40), ('bee', 5, 50),
+    ('bee', 6, 60), ('bee', 7, 70), ('bee', 8, 80), ('bee', 9, 90), ('bee', 10, 100),
+    ('cat', 1, 10), ('cat', 2, 20), ('cat', 3, 30), ('cat', 4, 40), ('cat', 5, 50),
+    ('cat', 6, 60), ('cat', 7, 70), ('cat', 8, 80), ('cat', 9, 90), ('cat', 10, 100);
+
+    -- a table whose rows note when they last changed, so only the rows that changed need pulling
+    create table quux (id int not null auto_increment,
+                       val int,
+                       updated_at timestamp not null default current_timestamp on update current_timestamp,
+                       primary key (id),
+                       key (updated_at));
+
+    insert into quux (val) values
+    (100), (101), (102), (103), (104), (105), (106), (107), (108), (109),
+    (110), (111), (112), (113), (114), (115), (116), (117), (118), (119);
+
+    -- as if they changed long ago
+    update quux set updated_at = '2020-01-01 00:00:00';
+
 -- this is where we make changes to see if they can be synced
 
 -- changes in the remote database (we expect these to appear downstream after sync)
@@ -315,6 +371,17 @@ update bar set val = 0 where id in (49, 98, 998, 999);
 insert into baz (val) values
 (20), (21), (22), (23), (24), (25), (26), (27), (28), (29);
 
+-- change, delete, and add rows by key (including one that sorts before every other key)
+update qux set val = 0 where (name, seq) in (('ant', 3), ('cat', 10));
+delete from qux where name = 'bee' and seq > 5;
+insert into qux (name, seq, val) values
+('aardvark', 1, 1), ('bee', 11, 110), ('dog', 1, 10);
+
+-- these change now (so updated_at does too), and one goes away
+update quux set val = 0 where id in (3, 7);
+insert into quux (val) values (120), (121);
+delete from quux where id = 10;
+
 -- We should tolerate the case below (uncomment to verify)
 -- but it's not the typical case, so leaving it commented out
 
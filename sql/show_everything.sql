@@ -29,3 +29,14 @@ union
 select u.id as upstream_id, u.val as upstream_val, d.id as downstream_id, d.val  as downstream_val
 from things_upstream.baz u
 right join things_downstream.baz d on u.id = d.id;
+
+select 'qux' as '';
+select u.name as upstream_name, u.seq as upstream_seq, u.val as upstream_val,
+       d.name as downstream_name, d.seq as downstream_seq, d.val as downstream_val
+from things_upstream.qux u
+left join things_downstream.qux d on u.name = d.name and u.seq = d.seq
+union
+select u.name as upstream_name, u.seq as upstream_seq, u.val as upstream_val,
+       d.name as downstream_name, d.seq as downstream_seq, d.val as downstream_val
+from things_upstream.qux u
+right join things_downstream.qux d on u.name = d.name and u.seq = d.seq;
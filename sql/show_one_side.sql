@@ -3,3 +3,5 @@ select * from foo_ref as r join foo_tokens as t on r.foo_token_id = t.id where n
 select * from bar;
 
 select * from baz;
+
+select * from qux order by name, seq;
@@ -67,3 +67,141 @@ control_after="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_on
 experimental_after="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
 
 report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Sync-after-nuke"
+
+echo "Starting over, with a second stale copy in 'things_downstream_qa'"
+mysql -uroot -ptest -e "source sql/init.sql;" | sed 's/^/    /g'
+mysql -uroot -ptest -e "drop database if exists things_downstream_qa; create database things_downstream_qa;"
+mysqldump -uroot -ptest things_downstream | mysql -uroot -ptest things_downstream_qa
+
+control_before="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+experimental_before="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+qa_before="$(mysql -uroot -ptest -e "use things_downstream_qa; source sql/show_one_side.sql;" | md5sum)"
+
+echo "Syncing into both, reading from 'things_upstream' once"
+pull_slice --also-into things_downstream_qa | sed 's/^/    /g'
+
+control_after="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+experimental_after="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+qa_after="$(mysql -uroot -ptest -e "use things_downstream_qa; source sql/show_one_side.sql;" | md5sum)"
+
+report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Fan-out-first-target"
+report "$control_before" "$qa_before" "$control_after" "$qa_after" "Fan-out-second-target"
+
+echo "Making changes only to 'qux' in things_upstream, which has a composite primary key"
+mysql -uroot -ptest -e "use things_upstream;
+                        update qux set val = val + 1 where seq % 3 = 0;
+                        delete from qux where name = 'ant' and seq < 4;
+                        insert into qux (name, seq, val) values ('aaa', 1, 1), ('cat', 11, 110), ('zebra', 1, 1);"
+
+control_before="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+experimental_before="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+
+echo "Syncing them by walking the primary key"
+pull_slice | sed 's/^/    /g'
+
+control_after="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+experimental_after="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+
+report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Keyset-sync"
+
+# 'quux' isn't in the slice, pulling its updated rows is tested on its own, three runs in a row:
+# the first reconciles in full, the second pulls what changed since, and the third (reconcile_every=3) reconciles again
+pull_quux() {
+    python3 - <<'PYTHON'
+from mysqlslice.cli import parse_pull_args, Prindenter
+from mysqlslice.mysql import LocalArgs, RemoteArgs, RemoteConnection
+from mysqlslice.sync import pull_updated_rows
+
+args = parse_pull_args()
+local_args = LocalArgs(args.local_user, args.local_password, args.local_database, args.local_socket)
+remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password, args.remote_database,
+                         cipher=args.cipher, port=args.remote_port)
+with RemoteConnection(remote_args) as remote_connection:
+    pull_updated_rows('quux', args, local_args, remote_connection, reconcile_every=3, printer=Prindenter())
+PYTHON
+}
+
+control_before="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_before="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+echo "Pulling updated rows of 'quux', no high-water mark yet so this reconciles it in full"
+rm -f .mysqlslice/watermark.things_downstream.quux.json
+pull_quux | sed 's/^/    /g'
+
+control_after="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_after="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Updated-rows-first-run"
+
+echo "Updating and adding rows of 'quux' in things_upstream"
+mysql -uroot -ptest -e "use things_upstream;
+                        update quux set val = val + 1 where id in (1, 2, 15);
+                        insert into quux (val) values (122);"
+
+control_before="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_before="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+echo "Pulling just the rows that changed since the last run"
+pull_quux | sed 's/^/    /g'
+
+control_after="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_after="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Updated-rows-incremental"
+
+echo "Deleting rows of 'quux' in things_upstream, which only a reconciling run can see"
+mysql -uroot -ptest -e "use things_upstream; delete from quux where id in (5, 6);"
+
+control_before="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_before="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+echo "Third run, so this one reconciles in full"
+pull_quux | sed 's/^/    /g'
+
+control_after="$(mysql -uroot -ptest -e "use things_upstream; select * from quux order by id;" | md5sum)"
+experimental_after="$(mysql -uroot -ptest -e "use things_downstream; select * from quux order by id;" | md5sum)"
+
+report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Updated-rows-reconcile"
+
+# binlog tailing needs the mysql-replication package, and a server writing a row based binlog
+tail_bar() {
+    python3 - <<'PYTHON'
+from mysqlslice.cli import parse_pull_args, Prindenter
+from mysqlslice.mysql import LocalArgs, RemoteArgs, RemoteConnection
+from mysqlslice.binlog import tail_binlog
+
+args = parse_pull_args()
+local_args = LocalArgs(args.local_user, args.local_password, args.local_database, args.local_socket)
+remote_args = RemoteArgs(args.remote_host, args.remote_user, args.remote_password, args.remote_database,
+                         cipher=args.cipher, port=args.remote_port)
+with RemoteConnection(remote_args) as remote_connection:
+    tail_binlog(['bar'], args, local_args, remote_connection, printer=Prindenter())
+PYTHON
+}
+
+if python3 -c "import pymysqlreplication" 2> /dev/null && \
+   [[ "$(mysql -uroot -ptest -N -e "select @@log_bin, @@binlog_format;")" == "$(printf '1\tROW')" ]] ; then
+
+    echo "Tailing the binlog for 'bar', no position yet so this syncs it the usual way"
+    rm -f .mysqlslice/binlog.things_downstream.bar.json
+    tail_bar | sed 's/^/    /g'
+
+    echo "Making changes to 'bar' in things_upstream"
+    mysql -uroot -ptest -e "use things_upstream;
+                            update bar set val = val + 1 where id % 7 = 0;
+                            delete from bar where id % 11 = 0;
+                            insert into bar (val) values (5000), (5001), (5002);"
+
+    control_before="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+    experimental_before="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+
+    echo "Applying those changes from the binlog"
+    tail_bar | sed 's/^/    /g'
+
+    control_after="$(mysql -uroot -ptest -e "use things_upstream; source sql/show_one_side.sql;" | md5sum)"
+    experimental_after="$(mysql -uroot -ptest -e "use things_downstream; source sql/show_one_side.sql;" | md5sum)"
+
+    report "$control_before" "$experimental_before" "$control_after" "$experimental_after" "Binlog-tailing"
+else
+    echo "Skipping Binlog-tailing, it needs mysql-replication (pip install mysqlslice[binlog]) and binlog_format=ROW"
+fi